@@ -1,201 +1,411 @@
 # -*- coding: utf-8 -*-
 
-import sys, time, traceback, signal, threading
+import os, sys, time, traceback, signal, functools
+from concurrent.futures.process import BrokenProcessPool
 import aiohttp
 import asyncio
-import janus
 try:
     import uvloop
     asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 except ImportError:
     pass
-from . import common, network, storage, state
+from . import backends, common, frontier, metrics, network, pipeline, pool, storage
 logger = common.logger
 
-WAIT_TIME = 1 # how many seconds to wait while polling
 RUNNING = True # whether crawl is running
 CACHE_QUEUE = '--queue' in sys.argv
 
 
 
-def crawl_complete(dl_queue, cache_queue, scrape_queue):
-    """Crawl is complete when each queue is empty with no pending items
-    """
-    return dl_queue.empty() and dl_queue._parent._unfinished_tasks == 0 and \
-           cache_queue.empty() and cache_queue._parent._unfinished_tasks == 0 and \
-           scrape_queue.empty() and scrape_queue._parent._unfinished_tasks == 0
-
-
-
-async def crawler(task_id, session, dl_queue, cache_queue, scrape_queue, proxy_manager, max_retries=1, user_agent=None, timeout=60):
+async def crawler(task_id, session, dl_queue, cache_queue, scrape_queue, proxy_manager, max_retries=1, user_agent=None, timeout=60, body_limits=None, stats=None):
     """Asynchronously download transactions from the download queue and send results on to the cache and scrape queues
     """
-    logger.debug('Start crawler: {}'.format(task_id))
+    logger.debug('Start crawler: {}', task_id)
+    stats = stats or metrics.FakeMetrics()
     while RUNNING:
-        if dl_queue.empty():
-            if crawl_complete(dl_queue, cache_queue, scrape_queue):
-                break
-            else:
-                # other workers still processing
-                c = asyncio.coroutine(lambda: not dl_queue.empty())
-                await asyncio.shield(asyncio.wait_for(c(), WAIT_TIME))
-        else:
-            try:
-                transaction = await dl_queue.get()
-                if not transaction.made() or transaction.can_retry(max_retries):
-                    # new request or retrying
-                    proxy = proxy_manager.get(transaction.url)
-                    user_agent = user_agent or proxy_manager.agent(proxy)
-                    await network.fetch(session, transaction, proxy=proxy, user_agent=user_agent)
-                    if transaction.is_error():
-                        logger.info('Download error: {}'.format(transaction))
-                        # received an error 
-                        transaction.num_errors += 1
-                        # add back to queue
-                        await dl_queue.put(transaction)
-                    else:
-                        # successfuly download 
-                        logger.info('Download: {}'.format(transaction))
-                        await cache_queue.put(transaction)
-                        await scrape_queue.put(transaction)
+        # wait for a host to be ready - None is returned when the crawl is complete
+        transaction = await dl_queue.get()
+        if transaction is None:
+            break
+        busy = time.time()
+        try:
+            if not transaction.made() or transaction.can_retry(max_retries):
+                # new request or retrying
+                proxy = proxy_manager.get(transaction.url)
+                user_agent = user_agent or proxy_manager.agent(proxy)
+                start = time.time()
+                await network.fetch(session, transaction, proxy=proxy, user_agent=user_agent, timeout=timeout, limits=body_limits)
+                latency = time.time() - start
+                dl_queue.record(transaction, latency)
+                stats.inc('downloads', label=transaction.status)
+                stats.observe('download_seconds', latency)
+                stats.observe('download_bytes', transaction.size())
+                if transaction.status in network.PROXY_ERRORS or transaction.status >= 500:
+                    proxy_manager.failure(proxy, transaction.url, latency)
                 else:
-                    # can not retry request so cache the error
-                    logger.info('Download fail: {}'.format(transaction))
-                    await cache_queue.put(transaction)
-            except Exception as e:
-                logger.error('Crawl error: {}: {}\n{}'.format(type(e), transaction, traceback.print_exc() or ''))
-            finally:
-                dl_queue.task_done()
-    logger.debug('Done crawler {}'.format(task_id))
+                    proxy_manager.success(proxy, transaction.url, latency)
+                if transaction.is_error():
+                    logger.info('Download error: {}', transaction)
+                    # received an error 
+                    transaction.num_errors += 1
+                    # add back to queue
+                    dl_queue.put(transaction)
+                elif transaction.not_modified():
+                    # the cache stage loads the cached response and then sends it to be scraped
+                    logger.info('Not modified: {}', transaction)
+                    cache_queue.put(transaction)
+                else:
+                    # successfuly download 
+                    logger.info('Download: {}', transaction)
+                    cache_queue.put(transaction)
+                    scrape_queue.put(transaction)
+            else:
+                # can not retry request so cache the error
+                logger.info('Download fail: {}', transaction)
+                cache_queue.put(transaction)
+        except Exception as e:
+            logger.error('Crawl error: {}: {}\n{}', type(e), transaction, traceback.format_exc())
+        finally:
+            dl_queue.task_done(transaction)
+            stats.inc('busy_seconds', time.time() - busy, 'download')
+    logger.debug('Done crawler {}', task_id)
     
 
 
-def threaded_cache(cache, dl_queue, cache_queue, scrape_queue):
+def threaded_cache(cache, dl_queue, cache_queue, scrape_queue, frontier_log, batch_size=100, stats=None):
     """This thread will load previously cached downloads and cache completed downloads
+    Transactions are processed in batches so the new requests can be looked up with a single query
     """
     logger.debug('Start cache')
+    stats = stats or metrics.FakeMetrics()
     while RUNNING:
-        logger.debug('dl-size:{} cache-size:{} scrape-size:{}'.format(dl_queue.qsize(), cache_queue.qsize(), scrape_queue.qsize()))
-        if cache_queue.empty():
-            if crawl_complete(dl_queue, cache_queue, scrape_queue):
-                break
-            else:
-                cond = threading.Condition()
-                cond.acquire()
-                cond.wait_for(lambda: not cache_queue.empty(), WAIT_TIME)
-        else:
-            try:
-                transaction = cache_queue.get()
-                key = hash(transaction)
-                if transaction.made():
+        # block until there is work - None is received when the crawl is complete
+        transactions = cache_queue.get_batch(batch_size)
+        if transactions is None:
+            break
+        busy = time.time()
+        try:
+            lookups, revalidations = [], []
+            for transaction in transactions:
+                key = transaction.fingerprint()
+                if transaction.not_modified():
+                    revalidations.append((key, transaction))
+                elif transaction.made():
                     # save complete request to cache
-                    logger.debug('Save cache: {}'.format(transaction))
-                    cache[key] = transaction
+                    logger.debug('Save cache: {}', transaction)
+                    cache.set(key, transaction, transaction.max_age())
+                    if transaction.is_error():
+                        # failed so will not be scraped
+                        frontier_log.done(transaction)
                 else:
-                    try:
-                        cached_transaction = cache[key]
-                    except KeyError:
-                        # still need to download request
-                        logger.debug('Cache miss: {}'.format(transaction))
-                        dl_queue.put(transaction)
+                    lookups.append((key, transaction))
+
+            downloads, scrapes = [], []
+            if revalidations:
+                fresh_transactions, stale_transactions = cache.lookup([key for key, _ in revalidations])
+                ages = {}
+                for key, transaction in revalidations:
+                    cached_transaction = fresh_transactions.get(key) or stale_transactions.get(key)
+                    if cached_transaction is None:
+                        # removed from the cache while revalidating so download again in full
+                        transaction.status, transaction.raw, transaction.conditional = 0, None, None
+                        downloads.append(transaction)
                     else:
-                        logger.debug('Load from cache: {}'.format(cached_transaction))
-                        # can process cached transaction
-                        # set the correct callback
-                        cached_transaction.merge(transaction)
-                        if not cached_transaction.made() or cached_transaction.is_error():
-                            cached_transaction.num_errors = 0
-                            dl_queue.put(cached_transaction)
-                        else:
-                            scrape_queue.put(cached_transaction)
-            except Exception as e:
-                logger.error('Cache exception: {}: {}\n{}'.format(type(e), transaction, traceback.print_exc() or ''))
-            finally:
-                cache_queue.task_done() 
+                        logger.debug('Revalidated cache: {}', transaction)
+                        transaction.revalidated(cached_transaction)
+                        ages[key] = transaction.max_age()
+                        scrapes.append(transaction)
+                cache.touch(ages)
+
+            cached_transactions, stale_transactions = cache.lookup([key for key, _ in lookups]) if lookups else ({}, {})
+            stats.inc('cache_lookups', len(cached_transactions), 'hit')
+            stats.inc('cache_lookups', len(stale_transactions), 'stale')
+            stats.inc('cache_lookups', len(lookups) - len(cached_transactions) - len(stale_transactions), 'miss')
+            for key, transaction in lookups:
+                cached_transaction = cached_transactions.get(key)
+                if cached_transaction is None:
+                    stale_transaction = stale_transactions.get(key)
+                    if stale_transaction is not None and not stale_transaction.is_error():
+                        # ask the server to only send the body if it has changed since cached
+                        transaction.conditional = stale_transaction.validators()
+                    # still need to download request
+                    logger.debug('Cache miss: {}', transaction)
+                    downloads.append(transaction)
+                else:
+                    logger.debug('Load from cache: {}', cached_transaction)
+                    # can process cached transaction
+                    # set the correct callback
+                    cached_transaction.merge(transaction)
+                    if not cached_transaction.made() or cached_transaction.is_error():
+                        cached_transaction.num_errors = 0
+                        downloads.append(cached_transaction)
+                    else:
+                        scrapes.append(cached_transaction)
+            dl_queue.put_many(downloads)
+            scrape_queue.put_many(scrapes)
+        except Exception as e:
+            logger.error('Cache exception: {}: {} transactions\n{}', type(e), len(transactions), traceback.format_exc())
+        finally:
+            for _ in transactions:
+                cache_queue.task_done()
+            stats.inc('busy_seconds', time.time() - busy, 'cache')
     logger.debug('Done cache')
 
 
 
 
-def threaded_scrape(user_crawl, dl_queue, cache_queue, scrape_queue):
+def threaded_scrape(user_crawl, dl_queue, cache_queue, scrape_queue, frontier_log, scrape_pool=None, stats=None, backend=None):
     """This thread will call the callback to scrape completed requests and add returned links to the download queue
+    If a scrape_pool is given the callbacks are run in its worker processes
+    The links that the backend does not crawl in this process are forwarded to it
     """
     logger.debug('Start scrape')
+    stats = stats or metrics.FakeMetrics()
     user_crawl.seen[user_crawl.start] = True
     while RUNNING:
-        if scrape_queue.empty():
-            if crawl_complete(dl_queue, cache_queue, scrape_queue):
-                break
-            else:
-                cond = threading.Condition()
-                cond.acquire()
-                cond.wait_for(lambda: not scrape_queue.empty(), WAIT_TIME)
-        else:
+        # block until there is work - None is received when the crawl is complete
+        transaction = scrape_queue.get()
+        if transaction is None:
+            break
+        if scrape_pool is not None and transaction.callback is not None:
+            logger.debug('Scrape callback: {}', transaction)
             try:
-                transaction = scrape_queue.get()
-                if transaction.callback is not None:
-                    logger.debug('Scrape callback: {}'.format(transaction))
-                    child_transactions = getattr(user_crawl, transaction.callback)(transaction)
-                    for child_transaction in child_transactions or []:
-                        if child_transaction not in user_crawl.seen:
-                            user_crawl.seen[child_transaction] = True
-                            cache_queue.put(child_transaction)
+                # the task is marked done when the results are received
+                scrape_pool.submit(transaction, functools.partial(scrape_done, user_crawl, cache_queue, scrape_queue, frontier_log, stats, backend, transaction))
+            except BrokenProcessPool:
+                # not marked done so is scraped when a durable crawl is resumed
+                logger.error('Scrape processes died so stopping the crawl: {}', transaction)
+                stop_crawl(scrape_queue.tracker)
+                scrape_queue.task_done()
             except Exception as e:
-                logger.error('Scrape exception: {}: {}\n{}'.format(type(e), transaction, traceback.print_exc() or ''))
-            finally:
+                logger.error('Scrape submit exception: {}: {}\n{}', type(e), transaction, traceback.format_exc())
+                frontier_log.done(transaction)
                 scrape_queue.task_done()
+            continue
+        try:
+            if transaction.callback is not None:
+                logger.debug('Scrape callback: {}', transaction)
+                start = time.time()
+                child_transactions = []
+                try:
+                    # consume a generator here so the whole callback is timed
+                    for child_transaction in getattr(user_crawl, transaction.callback)(transaction) or []:
+                        child_transactions.append(child_transaction)
+                finally:
+                    duration = time.time() - start
+                    stats.observe('scrape_seconds', duration, transaction.callback)
+                    stats.inc('busy_seconds', duration, 'scrape')
+                    # the links yielded before the callback failed are still crawled
+                    add_children(user_crawl, cache_queue, frontier_log, child_transactions, backend, parent=transaction)
+        except Exception as e:
+            logger.error('Scrape exception: {}: {}\n{}', type(e), transaction, traceback.format_exc())
+        finally:
+            frontier_log.done(transaction)
+            scrape_queue.task_done()
     logger.debug('Done scrape')
 
 
+def scrape_done(user_crawl, cache_queue, scrape_queue, frontier_log, stats, backend, transaction, future):
+    """Receive the results of a scrape callback that was run in the process pool
+    """
+    scraped = True
+    try:
+        child_transactions, rows, duration, error = future.result()
+        stats.observe('scrape_seconds', duration, transaction.callback)
+        stats.inc('busy_seconds', duration, 'scrape')
+        for row in rows:
+            user_crawl.writer.writerow(row)
+        # the links yielded before the callback failed are still crawled
+        add_children(user_crawl, cache_queue, frontier_log, child_transactions, backend, parent=transaction)
+        if error is not None:
+            logger.error('Scrape exception: {}\n{}', transaction, error)
+    except BrokenProcessPool:
+        # not marked done so is scraped when a durable crawl is resumed
+        scraped = False
+        logger.error('Scrape processes died so stopping the crawl: {}', transaction)
+        stop_crawl(scrape_queue.tracker)
+    except Exception as e:
+        logger.error('Scrape exception: {}: {}\n{}', type(e), transaction, traceback.format_exc())
+    finally:
+        if scraped:
+            frontier_log.done(transaction)
+        scrape_queue.task_done()
+
+
+def add_children(user_crawl, cache_queue, frontier_log, child_transactions, backend=None, parent=None):
+    """Add the child transactions that have not been seen before to the cache queue
+    When a backend is given the transactions it does not crawl in this process are forwarded to it instead
+    When the parent transaction is given the children are one step deeper, which are skipped beyond the crawler's max_depth
+    and otherwise given the priority from the crawler's score()
+    """
+    max_depth = getattr(user_crawl, 'max_depth', None)
+    score = getattr(user_crawl, 'score', None)
+    new_transactions, forward_transactions = [], []
+    for child_transaction in child_transactions or []:
+        if parent is not None:
+            child_transaction.depth = parent.depth + 1
+            if max_depth is not None and child_transaction.depth > max_depth:
+                continue # not marked seen so can still be reached by a shorter path
+            if score is not None:
+                child_transaction.priority = score(child_transaction)
+        if child_transaction not in user_crawl.seen:
+            user_crawl.seen[child_transaction] = True
+            if backend is None or backend.is_local(child_transaction):
+                new_transactions.append(child_transaction)
+            else:
+                forward_transactions.append(child_transaction)
+    if forward_transactions:
+        backend.forward(forward_transactions)
+    # record before queued so they are pending before the parent is done
+    frontier_log.add(new_transactions)
+    cache_queue.put_many(new_transactions)
+
+
 
-def signal_handler(signal, frame):
+def stop_crawl(tracker):
+    """Stop the crawl from a background thread, such as when it can not continue
+    """
+    global RUNNING
+    RUNNING = False
+    tracker.stop()
+
+
+def signal_handler(loop, tracker, signum, frame):
     """SIGINT signal caught so need to shutdown crawl
     """
     global RUNNING
     RUNNING = False
+    # wakeup the stages from the event loop because this handler may have interrupted a queue while locked
+    loop.call_soon_threadsafe(tracker.stop)
     print('Shutting down asyncrawler - press Ctrl+C again to terminate immediately')
 
 
 
 class BaseCrawler:
+    max_depth = None # optionally ignore links more than this many steps from the start
+
     def __init__(self):
         self.seen = storage.FakeDict()
 
+    def score(self, transaction):
+        """Return the priority of a newly discovered transaction, where higher priorities are downloaded first
+        By default keeps the priority set by the scrape callback, and can be overridden to favour pages such as listings and sitemaps
+        """
+        return transaction.priority
+
 
 
-def run(user_crawl, cache=None, num_workers=10, max_connections=10):
+def run(user_crawl, cache=None, num_workers=10, max_connections=10, delay=0, max_per_host=2, adaptive=True, scrape_processes=0, body_limits=None, metrics_interval=60, metrics_port=None, backend=None, connections_per_host=None, keepalive_timeout=30, dns_ttl=300, max_pending=None):
     """Run the given crawler
+
+    max_connections:
+        maximum number of open connections
+    delay:
+        minimum number of seconds between requests to the same host
+    max_per_host:
+        maximum number of concurrent downloads from the same host
+    adaptive:
+        whether to adapt the concurrent downloads for each host to its latency and errors, starting from half of max_per_host and never above it
+    scrape_processes:
+        how many processes to run the scrape callbacks in - by default they are run in a single thread
+    body_limits:
+        a network.BodyLimits to cap the size of response bodies and spool large ones to disk
+    metrics_interval:
+        how often in seconds to log a summary of the crawl metrics, or None to disable
+    metrics_port:
+        serve the crawl metrics in the Prometheus text format on this local port
+    backend:
+        where the frontier of pending transactions is kept - by default backends.MemoryBackend in this process,
+        or a backends.RemoteBackend to share the crawl with other machines
+    connections_per_host:
+        maximum number of open connections to the same host, by default limited only by max_connections
+    keepalive_timeout:
+        how many seconds to keep an idle connection open so the next request to its host can reuse it
+    dns_ttl:
+        how many seconds to cache the addresses of each host, which are resolved when the host is first added to the frontier
+    max_pending:
+        optionally the maximum number of downloads to keep pending in memory, after which those with a lower priority are spilled to disk
+
+    Returns the metrics.Metrics of the crawl
     """
     loop = asyncio.get_event_loop()
-    dl_queue = janus.LifoQueue(loop=loop) # use a stack for depth first traversal, to spread requests over the website
-    scrape_queue = janus.LifoQueue(loop=loop)
-    cache_queue = janus.LifoQueue(loop=loop)
-    cache = cache or storage.PersistentDict(common.get_hidden_path('cache.db'))
+    # the tracker counts work in every stage so they can all be woken when the crawl is complete
+    tracker = pipeline.Tracker()
+    stats = metrics.Metrics()
+    resolver = network.DNSCache(loop, ttl=dns_ttl, stats=stats)
+    backend = backend or backends.MemoryBackend()
+    def get_path(filename):
+        # the backend may run other crawls from this directory that need their own files
+        return common.get_hidden_path(backend.filename(filename))
+    # each host has its own heap for best first and then depth first traversal, to spread requests over the website
+    # max_per_host is the politeness limit so the adaptive limit stays within it
+    throttle = frontier.Throttle(start=max(1, max_per_host // 2), max_limit=max_per_host) if adaptive else None
+    spill = frontier.Spill(get_path('spill.db'), max_memory=max_pending) if max_pending else None
+    dl_queue = frontier.Frontier(loop, tracker, delay=delay, max_per_host=max_per_host, throttle=throttle, on_new_host=resolver.prefetch, spill=spill)
+    scrape_queue = pipeline.LifoQueue(tracker)
+    cache_queue = pipeline.LifoQueue(tracker)
+    if cache is None:
+        cache = storage.PersistentDict(get_path('cache.db'), batch_size=100)
     
-    if CACHE_QUEUE and state.load_queue(cache, dl_queue.sync_q, scrape_queue.sync_q):
-        logger.info('Loaded queue - downloads: {} scrapes: {}'.format(dl_queue.sync_q.qsize(), scrape_queue.sync_q.qsize()))
+    seen_file = get_path('seen.bloom')
+    if not CACHE_QUEUE and os.path.exists(seen_file):
+        # only kept for resuming a durable crawl
+        os.remove(seen_file)
+    # when durable the pending transactions are recorded so the crawl can be resumed after being interrupted
+    frontier_log = backend.open_log(get_path('frontier.db'), durable=CACHE_QUEUE)
+    pending = frontier_log.load()
+    if pending or backend.resuming:
+        logger.info('Loaded queue - pending: {}', len(pending))
         user_crawl.writer.mode = 'a'
-        pass # successfully loaded the cached queue
-    else:
+        if hasattr(user_crawl.seen, 'load') and user_crawl.seen.load(seen_file):
+            logger.info('Loaded seen - {} keys', len(user_crawl.seen))
+        for transaction in pending:
+            user_crawl.seen[transaction] = True
+        # the cache thread will send these on to be downloaded or scraped
+        cache_queue.put_many(pending)
+    elif backend.is_local(user_crawl.start):
         logger.debug('Default queue')
-        cache_queue.sync_q.put(user_crawl.start)
+        frontier_log.add([user_crawl.start])
+        cache_queue.put(user_crawl.start)
 
-    signal.signal(signal.SIGINT, signal_handler)
-    connector = aiohttp.TCPConnector(limit=max_connections)
+    # start the scrape processes before any threads
+    scrape_pool = pool.ScrapePool(user_crawl, scrape_processes) if scrape_processes else None
+    stats.workers = {'download': num_workers, 'cache': 1, 'scrape': scrape_processes or 1}
+    for name, queue in (('download', dl_queue), ('cache', cache_queue), ('scrape', scrape_queue)):
+        stats.gauge('queue_size', queue.qsize, name)
+    if metrics_interval:
+        stats.report(metrics_interval)
+    if metrics_port:
+        stats.serve(metrics_port)
+    # receive the transactions from the backend that were discovered by other crawls
+    backend.start(user_crawl, cache_queue, frontier_log, tracker)
+    signal.signal(signal.SIGINT, functools.partial(signal_handler, loop, tracker))
+    connector = network.connector(loop, limit=max_connections, limit_per_host=connections_per_host, keepalive_timeout=keepalive_timeout, resolver=resolver, stats=stats)
     # run background thread to load from and save to cache
     proxy_manager = network.ProxyManager(proxy_file='proxies.txt')
-    cache_future = loop.run_in_executor(None, threaded_cache, cache, dl_queue.sync_q, cache_queue.sync_q, scrape_queue.sync_q)
+    cache_future = loop.run_in_executor(None, functools.partial(threaded_cache, cache, dl_queue, cache_queue, scrape_queue, frontier_log, stats=stats))
     # run background thread to manage scraping
-    scrape_future = loop.run_in_executor(None, threaded_scrape, user_crawl, dl_queue.sync_q, cache_queue.sync_q, scrape_queue.sync_q)
+    scrape_future = loop.run_in_executor(None, threaded_scrape, user_crawl, dl_queue, cache_queue, scrape_queue, frontier_log, scrape_pool, stats, backend)
     with aiohttp.ClientSession(loop=loop, connector=connector) as session:
-        tasks = [crawler(task_id, session, dl_queue.async_q, cache_queue.async_q, scrape_queue.async_q, proxy_manager) for task_id in range(num_workers)]
+        body_limits = body_limits or network.BodyLimits()
+        tasks = [loop.create_task(crawler(task_id, session, dl_queue, cache_queue, scrape_queue, proxy_manager, body_limits=body_limits, stats=stats)) for task_id in range(num_workers)]
         loop.run_until_complete(asyncio.wait(tasks))
     loop.run_until_complete(cache_future)
     loop.run_until_complete(scrape_future)
-    if CACHE_QUEUE:
-        logger.info('Caching queue state')
-        state.save_queue(cache, dl_queue.sync_q, scrape_queue.sync_q)
-    else:
-        logger.debug('Clearing queue state')
-        state.clear_queue(cache)
+    if scrape_pool is not None:
+        scrape_pool.close()
+    if hasattr(getattr(user_crawl, 'writer', None), 'flush'):
+        # the rows are written by a background thread so make sure they are saved
+        user_crawl.writer.flush()
+    frontier_log.close()
+    if spill is not None:
+        spill.close()
+    stats.close()
+    for proxy, proxy_stats in proxy_manager.summary().items():
+        logger.info('Proxy {}: {requests} requests, {error_rate:.0%} errors, {latency} latency', proxy, **proxy_stats)
+    if CACHE_QUEUE and hasattr(user_crawl.seen, 'save'):
+        user_crawl.seen.save(seen_file)
+    cache.flush()
+    loop.run_until_complete(resolver.close())
     loop.close()
+    return stats
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+import os, socket, threading, time
+import xmlrpc.client
+from . import common, network, state
+logger = common.logger
+
+
+
+class MemoryBackend:
+    """Default backend where the frontier and seen set of the crawl are kept in this process
+
+    A backend decides which transactions are crawled in this process with is_local(),
+    takes the others with forward(), and can add transactions discovered elsewhere after start().
+    """
+    resuming = False # whether an interrupted crawl is being continued
+
+    def filename(self, filename):
+        """Return the name of the file used by this backend for filename
+        """
+        return filename
+
+    def open_log(self, filename, durable):
+        """Return the log of pending transactions, which is saved to filename when durable
+        Otherwise a log left by a previous crawl is removed so a later durable crawl does not resume from it
+        """
+        if durable:
+            return state.FrontierLog(filename)
+        for path in (filename, filename + '-wal', filename + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+        return state.FakeLog()
+
+    def is_local(self, transaction):
+        return True
+
+    def forward(self, transactions):
+        raise NotImplementedError('All transactions are crawled locally')
+
+    def start(self, user_crawl, cache_queue, frontier_log, tracker):
+        pass
+
+
+
+class RemoteBackend(MemoryBackend):
+    """Backend that shares the frontier and seen set through a coordinator.Coordinator, so the crawl can be spread over several machines
+    Transactions are leased from the coordinator in batches and the leases renewed until the transactions are complete,
+    so if this process is lost its transactions will be crawled by the other workers.
+
+    url:
+        the address of the coordinator, such as http://localhost:8765
+    name:
+        unique name of this worker - when given the hidden files get this suffix so several workers can run from the same directory
+    batch_size:
+        how many transactions to lease at once, which are leased once fewer than this are pending in this process
+    poll_interval:
+        how many seconds to wait before asking for more transactions when the coordinator has none
+    retries:
+        how many times to retry a request to the coordinator that fails
+    secret:
+        the shared secret the coordinator was started with
+    """
+    def __init__(self, url, name=None, batch_size=100, poll_interval=0.5, retries=5, secret=None):
+        self.url = url
+        self.secret = secret
+        self.name = name
+        self.worker = name or '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.batch_size, self.poll_interval, self.retries = batch_size, poll_interval, retries
+        self.lease_time = None
+        self.lock = threading.Lock()
+        self.leased = {} # fingerprint -> coordinator key of the transactions leased that are not complete
+        self.acks = [] # coordinator keys of the completed transactions to acknowledge
+        self.local = threading.local()
+
+
+    def call(self, method, *args):
+        """Call this method on the coordinator, retrying with a backoff when fails
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                # the connection can not be shared between threads
+                proxy = getattr(self.local, 'proxy', None)
+                if proxy is None:
+                    proxy = self.local.proxy = xmlrpc.client.ServerProxy(self.url, allow_none=True, use_builtin_types=True)
+                return getattr(proxy, method)(self.secret, *args)
+            except (OSError, xmlrpc.client.ProtocolError) as e:
+                self.local.proxy = None
+                if attempt == self.retries:
+                    raise
+                logger.warning('Coordinator error: {}: {}', method, e)
+                time.sleep(2 ** attempt)
+
+
+    def filename(self, filename):
+        if self.name:
+            root, ext = os.path.splitext(filename)
+            filename = '{}-{}{}'.format(root, self.name, ext)
+        return filename
+
+
+    def open_log(self, filename, durable):
+        # the coordinator records the pending transactions
+        return RemoteLog(self)
+
+
+    def is_local(self, transaction):
+        # all transactions go through the coordinator to be deduplicated and leased
+        return False
+
+
+    def forward(self, transactions):
+        """Add these transactions to the coordinator, which ignores those that have already been seen
+        """
+        self.call('add', [transaction.to_fields() for transaction in transactions])
+
+
+    def start(self, user_crawl, cache_queue, frontier_log, tracker):
+        # hold the tracker open until the coordinator reports the crawl is complete
+        tracker.add()
+        self.forward([user_crawl.start])
+        threading.Thread(target=self.receive, args=(cache_queue, tracker), daemon=True).start()
+
+
+    def receive(self, cache_queue, tracker):
+        """Lease transactions from the coordinator while the crawl is running
+        """
+        last_renew = time.time()
+        while not tracker.is_complete():
+            try:
+                self.flush()
+                if self.lease_time and time.time() - last_renew > self.lease_time / 3:
+                    last_renew = time.time()
+                    self.renew()
+                # the tracker also counts the lease of this thread
+                if tracker.pending - 1 < self.batch_size:
+                    result = self.call('lease', self.worker, self.batch_size)
+                    self.lease_time = result['lease_time']
+                    if result['complete']:
+                        tracker.finish()
+                        break
+                    # the keys are sent back as given in case the coordinator fingerprints differently
+                    leased = {}
+                    for key, fields in result['transactions']:
+                        transaction = network.Transaction.from_fields(fields)
+                        leased[transaction.fingerprint()] = key, transaction
+                    if leased:
+                        with self.lock:
+                            self.leased.update((fingerprint, key) for fingerprint, (key, _) in leased.items())
+                        cache_queue.put_many([transaction for _, transaction in leased.values()])
+                        continue
+            except Exception as e:
+                logger.error('Lease error: {}: {}', type(e), e)
+            time.sleep(self.poll_interval)
+
+
+    def renew(self):
+        """Extend the leases of the transactions still being crawled
+        """
+        with self.lock:
+            keys = list(self.leased.values())
+        if keys:
+            self.call('renew', self.worker, keys)
+
+
+    def ack(self, transaction):
+        """Record this transaction is complete, which is sent to the coordinator with the next flush
+        """
+        with self.lock:
+            key = self.leased.pop(transaction.fingerprint(), None)
+            if key is not None:
+                self.acks.append(key)
+
+
+    def flush(self):
+        """Acknowledge the completed transactions
+        """
+        with self.lock:
+            acks, self.acks = self.acks, []
+        if acks:
+            self.call('ack', self.worker, acks)
+
+
+
+class RemoteLog(state.FakeLog):
+    """Class with FrontierLog interface that acknowledges completed transactions to the coordinator
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def done(self, transaction):
+        self.backend.ack(transaction)
+
+    def close(self):
+        self.backend.flush()
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""Benchmark asyncrawler offline against a local synthetic website
+
+    python -m asyncrawler.benchmark --pages 2000 --hosts 8 --latency 0.02
+
+The website is a random link graph served on 127.0.0.1, 127.0.0.2, ... so that each host can be scheduled separately.
+Each scenario crawls it in a new process and reports pages/sec, download latency, peak memory, and cache size.
+"""
+
+import argparse, json, multiprocessing, os, random, re, resource, shutil, signal, subprocess, sys, tempfile, time
+import asyncio
+from aiohttp import web
+
+LINK_RE = re.compile(r'href="([^"]+)"')
+SCENARIOS = 'cold', 'warm', 'resume', 'hosts'
+
+
+
+class SyntheticSite:
+    """Generates a reproducible link graph where each page links to fan_out random pages
+
+    num_pages:
+        how many pages the website has
+    page_size:
+        the approximate number of bytes of each page
+    fan_out:
+        how many links each page has
+    latency:
+        how many seconds to wait before responding
+    error_rate:
+        the probability of responding with 503 instead of the page
+    seed:
+        the random seed used to generate the links and errors
+    """
+    def __init__(self, num_pages=1000, page_size=10000, fan_out=10, latency=0.01, error_rate=0, seed=0):
+        self.num_pages, self.page_size, self.fan_out = num_pages, page_size, fan_out
+        self.latency, self.error_rate, self.seed = latency, error_rate, seed
+        self.attempts = {} # page -> number of times requested
+
+
+    def links(self, page):
+        """Return the pages linked from this page, which always includes the next page so that every page is reachable
+        """
+        rand = random.Random(self.seed * self.num_pages + page)
+        children = [rand.randrange(self.num_pages) for _ in range(self.fan_out - 1)]
+        if page + 1 < self.num_pages:
+            children.append(page + 1)
+        return children
+
+
+    def fails(self, page):
+        """Return whether this request for the page should fail, which depends only on the seed, the page, and how many times it has been requested,
+        so the same errors are injected however the requests are ordered
+        """
+        attempt = self.attempts[page] = self.attempts.get(page, 0) + 1
+        return random.Random('{} {} {}'.format(self.seed, page, attempt)).random() < self.error_rate
+
+
+    def url(self, page, num_hosts, port):
+        """Return the URL of this page when the website is spread over num_hosts hosts
+        """
+        return 'http://127.0.0.{}:{}/{}/page/{}'.format(page % num_hosts + 1, port, num_hosts, page)
+
+
+    def render(self, page, num_hosts, port):
+        links = ''.join('<a href="{}">{}</a>\n'.format(self.url(child, num_hosts, port), child) for child in self.links(page))
+        html = '<html><head><title>Page {}</title></head><body>\n{}'.format(page, links)
+        padding = max(0, self.page_size - len(html) - 20)
+        return '{}<p>{}</p></body></html>'.format(html, 'x' * padding)
+
+
+    async def handle(self, request):
+        page, num_hosts = int(request.match_info['page']), int(request.match_info['hosts'])
+        if page >= self.num_pages:
+            return web.Response(status=404)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and self.fails(page):
+            return web.Response(status=503)
+        return web.Response(text=self.render(page, num_hosts, self.port), content_type='text/html')
+
+
+    def serve(self, num_hosts, port, ready):
+        """Serve the website on each host until the process is terminated
+        """
+        self.port = port
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        app = web.Application()
+        app.router.add_route('GET', '/{hosts}/page/{page}', self.handle)
+        handler = app.make_handler()
+        for i in range(num_hosts):
+            loop.run_until_complete(loop.create_server(handler, '127.0.0.{}'.format(i + 1), port))
+        ready.set()
+        loop.run_forever()
+
+
+
+def free_port():
+    import socket
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def crawl(config):
+    """Crawl the synthetic website in this process and save the results as JSON
+    This is run in a new process for each scenario so the memory use is measured separately
+    """
+    from asyncrawler import asyncrawler, network, storage, writers
+    config = json.loads(config)
+
+    class BenchmarkCrawl(asyncrawler.BaseCrawler):
+        def __init__(self):
+            self.start = network.Transaction(config['start'], callback=self.crawl)
+            # a Bloom filter can be saved to resume the crawl
+            self.seen = storage.BloomDict(max(1000, 2 * config['pages']))
+            self.writer = writers.CacheWriter('results.csv', ['URL'])
+            self.pages = 0
+
+        def crawl(self, transaction):
+            self.pages += 1
+            self.writer.writerow([transaction.url])
+            if self.pages == config.get('stop_after'):
+                # interrupt the crawl like Ctrl+C so the resume scenario can continue it
+                os.kill(os.getpid(), signal.SIGINT)
+            for link in LINK_RE.findall(transaction.body or ''):
+                yield network.Transaction(link, callback=self.crawl)
+
+    user_crawl = BenchmarkCrawl()
+    cache = storage.PersistentDict('cache.db', batch_size=100)
+    start = time.time()
+    stats = asyncrawler.run(user_crawl, cache=cache, num_workers=config['workers'], max_connections=config['workers'], max_per_host=config['max_per_host'], metrics_interval=None)
+    elapsed = time.time() - start
+    cache.close()
+    latency = stats.merge('download_seconds')
+    with open('results.json', 'w') as fp:
+        json.dump({
+            'pages': user_crawl.pages,
+            'downloads': latency.count,
+            'seconds': elapsed,
+            'p50': latency.quantile(0.5),
+            'p99': latency.quantile(0.99),
+            'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            'cache': sum(os.path.getsize(filename) for filename in os.listdir('.') if filename.startswith('cache.db')),
+            }, fp)
+
+
+def run_crawl(workdir, config, queue=False):
+    """Crawl in a new process with workdir as the current directory and return the results
+    """
+    # the hidden files are stored relative to the script name so set it before asyncrawler is imported
+    code = "import sys; sys.argv[0] = 'benchmark'; from asyncrawler import benchmark; benchmark.crawl(sys.argv[1])"
+    args = [sys.executable, '-c', code, json.dumps(config)]
+    if queue:
+        args.append('--queue')
+    env = dict(os.environ)
+    # so the asyncrawler package can be imported
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(os.path.dirname(os.path.abspath(__file__))), env.get('PYTHONPATH')]))
+    # the crawl log is in the hidden directory so discard the output
+    subprocess.run(args, cwd=workdir, env=env, stdout=subprocess.DEVNULL, check=True)
+    with open(os.path.join(workdir, 'results.json')) as fp:
+        return json.load(fp)
+
+
+def run_scenario(name, site, args, port):
+    """Run a benchmark scenario and return a list of (label, results)
+    """
+    config = {'workers': args.workers, 'max_per_host': args.max_per_host, 'pages': site.num_pages, 'start': site.url(0, args.hosts, port)}
+    workdir = tempfile.mkdtemp(prefix='asyncrawler-benchmark-')
+    try:
+        if name == 'cold':
+            return [('cold', run_crawl(workdir, config))]
+        elif name == 'warm':
+            run_crawl(workdir, config)
+            return [('warm', run_crawl(workdir, config))]
+        elif name == 'resume':
+            interrupted = run_crawl(workdir, dict(config, stop_after=site.num_pages // 2), queue=True)
+            return [('interrupted', interrupted), ('resume', run_crawl(workdir, config, queue=True))]
+        elif name == 'hosts':
+            results = []
+            for num_hosts in (1, args.hosts):
+                shutil.rmtree(workdir)
+                os.mkdir(workdir)
+                results.append(('{} host{}'.format(num_hosts, '' if num_hosts == 1 else 's'), run_crawl(workdir, dict(config, start=site.url(0, num_hosts, port)))))
+            return results
+        else:
+            raise ValueError('Unknown scenario: {}'.format(name))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def report(label, results):
+    print('{:<12} {:>7} pages {:>8.1f} pages/s  p50 {!s:>6}s  p99 {!s:>6}s  rss {:>7.1f}MB  cache {:>7.1f}MB'.format(
+        label, results['pages'], results['pages'] / max(results['seconds'], 1e-6), results['p50'], results['p99'],
+        results['rss'] / 1024 ** 2, results['cache'] / 1024 ** 2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark asyncrawler against a local synthetic website')
+    parser.add_argument('--pages', type=int, default=1000, help='number of pages in the website')
+    parser.add_argument('--page-size', type=int, default=10000, help='bytes in each page')
+    parser.add_argument('--fan-out', type=int, default=10, help='links on each page')
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds for the server to respond')
+    parser.add_argument('--error-rate', type=float, default=0, help='probability of a 503 response')
+    parser.add_argument('--hosts', type=int, default=8, help='number of hosts to spread the website over')
+    parser.add_argument('--workers', type=int, default=20, help='number of concurrent downloads')
+    parser.add_argument('--max-per-host', type=int, default=4, help='initial concurrent downloads for each host')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated scenarios from: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the link graph and errors')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    site = SyntheticSite(args.pages, args.page_size, args.fan_out, args.latency, args.error_rate, args.seed)
+    port = free_port()
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=site.serve, args=(args.hosts, port, ready), daemon=True)
+    server.start()
+    ready.wait()
+    try:
+        results = []
+        for name in args.scenarios.split(','):
+            for label, result in run_scenario(name.strip(), site, args, port):
+                results.append(dict(result, scenario=label))
+                if not args.json:
+                    report(label, result)
+        if args.json:
+            print(json.dumps(results, indent=2))
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
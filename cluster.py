@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing, os, queue, signal, threading, traceback
+from . import asyncrawler, backends, common, frontier, metrics, network, state, writers
+logger = common.logger
+
+
+
+def get_shard(url, num_shards):
+    """Return the index of the shard that owns the host of this URL
+
+    >>> get_shard('http://example.com/a', 4) == get_shard('HTTP://EXAMPLE.COM:80/b', 4)
+    True
+    >>> 0 <= get_shard('http://webscraping.com', 4) < 4
+    True
+    """
+    return common.hash(frontier.get_host(url)) % num_shards
+
+
+def shard_filename(filename, index):
+    """Return the filename used by this shard
+
+    >>> shard_filename('results.csv', 2)
+    'results-2.csv'
+    """
+    root, ext = os.path.splitext(filename)
+    return '{}-{}{}'.format(root, index, ext)
+
+
+
+class Cluster:
+    """State shared by the launcher and the processes of a clustered crawl
+
+    Each shard has an inbox queue for the transactions forwarded to it, and counts how many it has sent and received.
+    The crawl is complete when every shard is idle and all the transactions sent have been received,
+    which must be seen twice in a row with the same counts so that a transaction can not be missed in transit.
+    """
+    def __init__(self, num_shards, context):
+        self.num_shards = num_shards
+        self.inboxes = [context.Queue() for _ in range(num_shards)]
+        # each shard only updates its own element so no locks are needed
+        self.sent = context.Array('q', num_shards, lock=False)
+        self.received = context.Array('q', num_shards, lock=False)
+        self.idle = context.Array('b', num_shards, lock=False)
+        self.done = context.Event() # all shards are complete
+        self.abort = context.Event() # stop all shards now, such as when interrupted
+        self.results = context.Queue()
+        self.resuming = False
+
+
+    def snapshot(self):
+        """Return the counts if every shard is idle and has received all the transactions sent, else None
+        """
+        sent, received = tuple(self.sent), tuple(self.received)
+        if all(self.idle) and sum(sent) == sum(received):
+            return sent, received
+
+
+    def drain(self):
+        """Remove and return the (shard index, serialized transactions) that have not been received
+        """
+        batches = []
+        for index, inbox in enumerate(self.inboxes):
+            while True:
+                try:
+                    batches.append((index, inbox.get_nowait()))
+                except queue.Empty:
+                    break
+        return batches
+
+
+
+class Shard(backends.MemoryBackend):
+    """Backend for the part of a clustered crawl run by one process, which owns the hosts that hash to its index
+    Transactions for hosts owned by other shards are forwarded to their inbox
+    """
+    def __init__(self, cluster, index):
+        self.cluster = cluster
+        self.index = index
+        self.resuming = cluster.resuming
+
+
+    def filename(self, filename):
+        return shard_filename(filename, self.index)
+
+
+    def is_local(self, transaction):
+        return get_shard(transaction.url, self.cluster.num_shards) == self.index
+
+
+    def forward(self, transactions):
+        """Send these transactions to the shards that own their hosts
+        """
+        batches = {}
+        for transaction in transactions:
+            batches.setdefault(get_shard(transaction.url, self.cluster.num_shards), []).append(transaction.dumps())
+        for index, batch in batches.items():
+            # counted before sending so the transactions are in transit until received
+            self.cluster.sent[self.index] += len(batch)
+            self.cluster.inboxes[index].put(batch)
+
+
+    def start(self, user_crawl, cache_queue, frontier_log, tracker):
+        """Start receiving the transactions forwarded from other shards in a background thread
+        """
+        # hold the tracker open while other shards may still forward transactions
+        tracker.add()
+        threading.Thread(target=self.receive, args=(user_crawl, cache_queue, frontier_log, tracker), daemon=True).start()
+
+
+    def receive(self, user_crawl, cache_queue, frontier_log, tracker):
+        cluster = self.cluster
+        inbox = cluster.inboxes[self.index]
+        try:
+            while not tracker.is_complete():
+                if cluster.abort.is_set():
+                    tracker.stop()
+                    break
+                if cluster.done.is_set():
+                    tracker.finish()
+                    break
+                try:
+                    batch = inbox.get(timeout=0.05)
+                except queue.Empty:
+                    # only this receiver is left in the tracker so no work is in progress
+                    cluster.idle[self.index] = tracker.pending <= 1
+                    continue
+                cluster.idle[self.index] = False
+                try:
+                    asyncrawler.add_children(user_crawl, cache_queue, frontier_log, [network.Transaction.loads(data) for data in batch])
+                except Exception as e:
+                    logger.error('Receive error: {}: {}: {} transactions\n{}', type(e), e, len(batch), traceback.format_exc())
+                finally:
+                    # counted even when failed so the cluster can still complete
+                    cluster.received[self.index] += len(batch)
+        except BaseException:
+            # stop the cluster, which can be resumed, rather than leave every shard waiting on this receiver
+            logger.error('Receive thread failed so stopping the cluster')
+            cluster.abort.set()
+            tracker.stop()
+            raise
+
+
+
+def run_shard(user_crawl, shard, kwargs):
+    """Run the crawl for this shard in a child process and send back its metrics
+    """
+    writer = getattr(user_crawl, 'writer', None)
+    if hasattr(writer, 'filename'):
+        writer.filename = shard.filename(writer.filename)
+    if kwargs.get('metrics_port'):
+        kwargs = dict(kwargs, metrics_port=kwargs['metrics_port'] + shard.index)
+    stats = asyncrawler.run(user_crawl, backend=shard, **kwargs)
+    if hasattr(writer, 'close'):
+        # the process exits without flushing open files
+        writer.close()
+    shard.cluster.results.put(stats)
+
+
+def merge_outputs(writer, num_shards, remove):
+    """Combine the output files of the shards into the writer's file
+    The shard files are kept when the crawl is not complete so they can be appended to when resumed
+    """
+    if not getattr(writer, 'mergeable', True):
+        return # such as Parquet files, which are kept separate
+    filenames = [filename for index in range(num_shards) for filename in writers.part_filenames(shard_filename(writer.filename, index))]
+    header = getattr(writer, 'header', None) if isinstance(writer, writers.CacheWriter) else None
+    written = False
+    with writers.open_file(writer.filename, 'w') as output:
+        for filename in filenames:
+            with writers.open_file(filename, 'r') as fp:
+                if header and written:
+                    fp.readline() # only keep the first header
+                for line in fp:
+                    output.write(line)
+            written = True
+            if remove:
+                os.remove(filename)
+
+
+def launch(user_crawl, num_processes=None, check_interval=0.1, **kwargs):
+    """Run the crawl in num_processes processes that each own a shard of the hosts, with their own event loop, connections, and cache
+    By default uses a process for each core. The other arguments are passed to asyncrawler.run() in each process.
+
+    Returns the metrics.Metrics of all the shards
+    """
+    num_processes = num_processes or multiprocessing.cpu_count()
+    # fork so the crawler does not need to be picklable
+    context = multiprocessing.get_context('fork')
+    cluster = Cluster(num_processes, context)
+    frontier_files = [common.get_hidden_path(shard_filename('frontier.db', index)) for index in range(num_processes)]
+    if asyncrawler.CACHE_QUEUE:
+        for filename in frontier_files:
+            if os.path.exists(filename):
+                frontier_log = state.FrontierLog(filename)
+                cluster.resuming = cluster.resuming or len(frontier_log) > 0
+                frontier_log.close()
+
+    stats = metrics.Metrics()
+    # the processes inherit this handler until they start crawling
+    previous_handler = signal.signal(signal.SIGINT, lambda signum, frame: cluster.abort.set())
+    processes = [context.Process(target=run_shard, args=(user_crawl, Shard(cluster, index), kwargs)) for index in range(num_processes)]
+    for process in processes:
+        process.start()
+    logger.info('Launched {} crawl processes', num_processes)
+
+    previous, unsent = None, []
+    while any(process.is_alive() for process in processes):
+        if not (cluster.done.is_set() or cluster.abort.is_set()):
+            if any(process.exitcode not in (None, 0) for process in processes):
+                logger.error('Crawl process failed so stopping the cluster')
+                cluster.abort.set()
+            else:
+                snapshot = cluster.snapshot()
+                if snapshot is not None and snapshot == previous:
+                    cluster.done.set()
+                previous = snapshot
+        if cluster.abort.is_set():
+            # keep the transactions forwarded to shards that have stopped so the crawl can be resumed
+            unsent.extend(cluster.drain())
+        try:
+            # read the results while waiting so the processes can exit
+            stats.add(cluster.results.get(timeout=check_interval))
+        except queue.Empty:
+            pass
+    for process in processes:
+        process.join()
+    while True:
+        try:
+            stats.add(cluster.results.get_nowait())
+        except queue.Empty:
+            break
+    unsent.extend(cluster.drain())
+    signal.signal(signal.SIGINT, previous_handler)
+
+    if unsent and asyncrawler.CACHE_QUEUE:
+        logger.info('Saving {} forwarded transactions', sum(len(batch) for _, batch in unsent))
+        for index, batch in unsent:
+            frontier_log = state.FrontierLog(frontier_files[index])
+            frontier_log.add([network.Transaction.loads(data) for data in batch])
+            frontier_log.close()
+    writer = getattr(user_crawl, 'writer', None)
+    if hasattr(writer, 'filename'):
+        merge_outputs(writer, num_processes, remove=cluster.done.is_set())
+    logger.info('Metrics: {}', stats.summary())
+    return stats
@@ -1,15 +1,69 @@
 # -*- coding: utf-8 -*-
 
-import sys, os, hashlib, re, html, unicodedata
+import sys, os, hashlib, re, html, unicodedata, atexit, queue, threading, time
 from datetime import datetime
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 DEBUG = '--debug' in sys.argv
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+DEBUG_LEVEL, INFO_LEVEL, WARNING_LEVEL, ERROR_LEVEL = 10, 20, 30, 40
+LEVEL_NAMES = {DEBUG_LEVEL: 'Debug', INFO_LEVEL: 'Info', WARNING_LEVEL: 'Warning', ERROR_LEVEL: 'Error'}
 
 
 def hash(s):
-    """Produce consistent hash for input - in Python 3 hashes change each runtime
+    """Produce consistent 64 bit hash for input - in Python 3 hashes change each runtime
+    Always uses blake2b so the keys of the cache, frontier log, and Bloom filter do not depend on which packages are installed.
+    The result is signed so can be stored as a sqlite INTEGER.
+
+    >>> hash('abc') == hash(b'abc')
+    True
+    >>> hash('abc')
+    6455300059550759896
+    """
+    if isinstance(s, str):
+        s = s.encode()
+    h = int.from_bytes(hashlib.blake2b(s, digest_size=8).digest(), 'little')
+    return h - 2 ** 64 if h >= 2 ** 63 else h
+
+
+def canonical_url(url):
+    """Normalize URL so that equivalent URLs are equal
+    The scheme and host are lower cased, the default port and fragment removed, and the query sorted
+
+    >>> canonical_url('HTTP://WebScraping.com:80/blog?b=2&a=1#comments')
+    'http://webscraping.com/blog?a=1&b=2'
+    >>> canonical_url('https://webscraping.com')
+    'https://webscraping.com/'
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.hostname or ''
+    if parts.username is not None:
+        netloc = '{}@{}'.format(parts.netloc.rpartition('@')[0], netloc)
+    if parts.port is not None and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc = '{}:{}'.format(netloc, parts.port)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+
+
+def get_domain(url):
+    """Return the domain of this URL, without the www subdomain
+
+    >>> get_domain('http://WWW.webscraping.com:8080/blog')
+    'webscraping.com'
+    """
+    host = urlsplit(url).hostname or ''
+    return host[4:] if host.startswith('www.') else host
+
+
+def same_domain(url1, url2):
+    """Return whether these URLs have the same domain
+
+    >>> same_domain('http://webscraping.com', 'https://www.webscraping.com/blog')
+    True
+    >>> same_domain('http://webscraping.com', 'http://example.com')
+    False
     """
-    h = hashlib.md5(s.encode())
-    return int(h.hexdigest(), base=16)
+    return get_domain(url1) == get_domain(url2)
 
 
 def get_hidden_path(filename):
@@ -49,25 +103,175 @@ def normalize(s, default=''):
 
 
 class Logger:
-    def __init__(self, output_file):
-        self.fp = open(output_file, 'a')
+    """Logs to the hidden log file and stdout from a background thread, so logging never waits on I/O
+    Arguments are only formatted when the level is enabled: logger.info('Download: {}', transaction)
+    High volume messages can be limited by their template with throttle() or sample()
+
+    output_file:
+        the file to log to
+    level:
+        the minimum level to log - by default DEBUG_LEVEL with --debug else INFO_LEVEL
+    max_queue:
+        the maximum number of messages waiting to be written - when full, debug and info messages are dropped
+    max_bytes:
+        rotate the log file once it exceeds this size
+    backup_count:
+        how many rotated log files to keep
+    """
+    def __init__(self, output_file, level=None, max_queue=10000, max_bytes=100 * 1024 ** 2, backup_count=3):
+        self.output_file = output_file
+        self.level = level or (DEBUG_LEVEL if DEBUG else INFO_LEVEL)
+        self.max_queue, self.max_bytes, self.backup_count = max_queue, max_bytes, backup_count
+        self.limits = {} # message template -> LogLimit
+        self.fp = None
+        self.start()
+        if hasattr(os, 'register_at_fork'):
+            # threads are not copied into forked processes so need a new writer
+            os.register_at_fork(after_in_child=self.start)
+        atexit.register(self.close)
+
+    def start(self):
+        self.queue = queue.Queue(self.max_queue)
+        self.dropped = 0
+        self.writer = threading.Thread(target=self._write, daemon=True)
+        self.writer.start()
 
-    def debug(self, message):
-        self._output('Debug', message, DEBUG)
+    def debug(self, message, *args, **kwargs):
+        if self.level <= DEBUG_LEVEL:
+            self._log(DEBUG_LEVEL, message, args, kwargs)
 
-    def info(self, message):
-        self._output('Info', message, True)
+    def info(self, message, *args, **kwargs):
+        if self.level <= INFO_LEVEL:
+            self._log(INFO_LEVEL, message, args, kwargs)
 
-    def warning(self, message):
-        self._output('Warning', message, True)
+    def warning(self, message, *args, **kwargs):
+        if self.level <= WARNING_LEVEL:
+            self._log(WARNING_LEVEL, message, args, kwargs)
+
+    def error(self, message, *args, **kwargs):
+        if self.level <= ERROR_LEVEL:
+            self._log(ERROR_LEVEL, message, args, kwargs)
+
+    def throttle(self, message, interval):
+        """Log messages with this template at most once per interval seconds
+        """
+        self.limits[message] = LogLimit(interval=interval)
+
+    def sample(self, message, rate):
+        """Log only 1 in rate of the messages with this template
+        """
+        self.limits[message] = LogLimit(rate=rate)
+
+    def _log(self, level, message, args, kwargs):
+        if self.limits:
+            limit = self.limits.get(message)
+            if limit is not None and not limit.allow():
+                return
+        if args or kwargs:
+            # formatted here rather than by the writer in case the arguments are modified
+            try:
+                message = message.format(*args, **kwargs)
+            except Exception as e:
+                message = '{} {} {}: {}'.format(message, args, kwargs, e)
+        record = time.time(), level, message
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if level >= WARNING_LEVEL:
+                # do not lose problems, but write them directly if the writer has stopped rather than waiting forever
+                while self.writer.is_alive():
+                    try:
+                        self.queue.put(record, timeout=1)
+                        return
+                    except queue.Full:
+                        pass
+                self.report(record)
+            else:
+                self.dropped += 1
+
+    def _write(self):
+        written = 0
+        errors = set() # the write errors already reported
+        while True:
+            record = self.queue.get()
+            try:
+                if record is None:
+                    break
+                if self.fp is None:
+                    self.fp = open(self.output_file, 'a')
+                when, level, message = record
+                prefix = LEVEL_NAMES[level]
+                self.fp.write('{}: {}: {}\n'.format(datetime.fromtimestamp(when), prefix, message))
+                print('{}: {}'.format(prefix, message))
+                if self.dropped:
+                    dropped, self.dropped = self.dropped, 0
+                    self.fp.write('{}: Warning: {} log messages dropped\n'.format(datetime.now(), dropped))
+                written += 1
+                if self.queue.empty() or written % 1000 == 0:
+                    self.fp.flush()
+                    if self.fp.tell() > self.max_bytes:
+                        self.rotate()
+            except Exception as e:
+                # keep writing the later messages, such as to the log file when stdout is a closed pipe
+                if repr(e) not in errors:
+                    errors.add(repr(e))
+                    self.report((time.time(), ERROR_LEVEL, 'Log write error: {}'.format(e)))
+            finally:
+                self.queue.task_done()
+        if self.fp is not None:
+            self.fp.flush()
+
+    def report(self, record):
+        """Write this record directly to stderr, for when the writer thread can not
+        """
+        when, level, message = record
+        try:
+            sys.stderr.write('{}: {}\n'.format(LEVEL_NAMES[level], message))
+        except Exception:
+            pass
+
+    def rotate(self):
+        """Move the log file to output_file.1 and the older logs up to output_file.<backup_count>
+        """
+        self.fp.close()
+        self.fp = None
+        for i in range(self.backup_count, 0, -1):
+            src = self.output_file if i == 1 else '{}.{}'.format(self.output_file, i - 1)
+            if os.path.exists(src):
+                os.replace(src, '{}.{}'.format(self.output_file, i))
+        if not self.backup_count:
+            os.remove(self.output_file)
+
+    def flush(self):
+        """Wait until all the logged messages are written, or the writer thread has stopped
+        """
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks and self.writer.is_alive():
+                self.queue.all_tasks_done.wait(1)
+
+    def close(self):
+        if self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+
+
+
+class LogLimit:
+    """Decides whether to log each message with a template, either at most once per interval seconds or 1 in rate
+    """
+    def __init__(self, interval=None, rate=None):
+        self.interval, self.rate = interval, rate
+        self.count = 0
+        self.last = 0
 
-    def error(self, message):
-        self._output('Error', message, True)
+    def allow(self):
+        self.count += 1
+        if self.rate:
+            return (self.count - 1) % self.rate == 0
+        now = time.time()
+        if now - self.last >= self.interval:
+            self.last = now
+            return True
+        return False
 
-    def _output(self, prefix, message, display):
-        s = '{}: {}'.format(prefix, message)
-        self.fp.write('{}: {}\n'.format(datetime.now(), message))
-        #self.fp.flush()
-        if display:
-            print(s)
 logger = Logger(get_hidden_path('asyncrawler.log'))
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""Coordinator that shares the frontier and seen set of a crawl between workers on several machines
+
+    python -m asyncrawler.coordinator --port 8765 --filename frontier.db --secret $SECRET
+
+Then each worker runs the crawl with asyncrawler.run(user_crawl, backend=backends.RemoteBackend('http://host:8765', secret=SECRET)).
+The transactions are sent as plain XML-RPC data rather than pickled, so a client can not run code on the coordinator,
+and when a secret is given every call must include it.
+"""
+
+import argparse, collections, hmac, ipaddress, os, threading, time
+from socketserver import ThreadingMixIn
+from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from . import common, network, state, storage
+logger = common.logger
+
+
+
+class Coordinator:
+    """Leases the pending transactions to workers and deduplicates the transactions they discover
+    A leased transaction is returned to the pending stack if the worker does not acknowledge it or renew the lease in time,
+    so the crawl continues when a worker is lost, though its transactions may then be crawled twice.
+
+    lease_time:
+        how many seconds a worker has to complete a transaction before it is leased to another worker
+    filename:
+        optional sqlite database to record the pending transactions and seen set so the coordinator can be restarted
+    capacity, error_rate:
+        the size of the Bloom filter for the seen set
+    """
+    def __init__(self, lease_time=60, filename=None, capacity=10 ** 7, error_rate=0.001):
+        self.lease_time = lease_time
+        self.lock = threading.Lock()
+        self.pending = collections.OrderedDict() # key -> transaction fields, leased from the end like the local stacks
+        self.leases = {} # key -> (worker, expiry time, transaction fields)
+        self.seen = storage.BloomDict(capacity, error_rate)
+        self.num_added = self.num_acked = 0
+        self.started = False # whether any transactions have been added, seen, or loaded, so an empty frontier means the crawl is complete
+        self.filename = filename
+        if filename is None:
+            self.frontier_log = state.FakeLog()
+        else:
+            self.frontier_log = state.FrontierLog(filename)
+            # a restored seen set means a previous crawl started, even when it finished with nothing pending
+            self.started = self.seen.load(filename + '.bloom') and self.seen.count > 0
+            for transaction in self.frontier_log.load():
+                key = transaction.fingerprint()
+                self.seen[key] = True
+                self.pending[key] = transaction.to_fields()
+            if self.pending:
+                logger.info('Loaded queue - pending: {}', len(self.pending))
+                self.started = True
+
+
+    def add(self, transactions):
+        """Add the transactions that have not been seen before, which are the fields from Transaction.to_fields()
+        Returns the number added
+        """
+        new_transactions = []
+        for fields in transactions:
+            try:
+                transaction = network.Transaction.from_fields(fields)
+            except ValueError as e:
+                logger.warning('Coordinator ignored transaction: {}', e)
+                continue
+            key = transaction.fingerprint()
+            with self.lock:
+                # the crawl has started even when the start transaction was already seen by a previous crawl
+                self.started = True
+                if key in self.seen:
+                    continue
+                self.seen[key] = True
+                self.pending[key] = transaction.to_fields()
+                self.num_added += 1
+            new_transactions.append(transaction)
+        self.frontier_log.add(new_transactions)
+        return len(new_transactions)
+
+
+    def lease(self, worker, max_items):
+        """Lease up to max_items pending transactions to this worker
+        Returns the transactions as [key, transaction fields] pairs, the lease time,
+        and whether the crawl is complete because nothing is pending or leased
+        """
+        self.expire()
+        transactions = []
+        expires = time.time() + self.lease_time
+        with self.lock:
+            while self.pending and len(transactions) < max_items:
+                key, fields = self.pending.popitem()
+                self.leases[key] = worker, expires, fields
+                # xmlrpc integers are only 32 bit
+                transactions.append([str(key), fields])
+            complete = not self.pending and not self.leases and self.started
+        return {'transactions': transactions, 'lease_time': self.lease_time, 'complete': complete}
+
+
+    def renew(self, worker, keys):
+        """Extend the leases this worker holds on these transactions
+        Returns the number renewed
+        """
+        expires = time.time() + self.lease_time
+        renewed = 0
+        with self.lock:
+            for key in keys:
+                lease = self.leases.get(int(key))
+                if lease is not None and lease[0] == worker:
+                    self.leases[int(key)] = worker, expires, lease[2]
+                    renewed += 1
+        return renewed
+
+
+    def ack(self, worker, keys):
+        """Record these transactions are complete
+        Returns the number acknowledged
+        """
+        done = []
+        with self.lock:
+            for key in keys:
+                lease = self.leases.pop(int(key), None)
+                if lease is not None:
+                    done.append(lease[2])
+            self.num_acked += len(done)
+        for fields in done:
+            self.frontier_log.done(network.Transaction.from_fields(fields))
+        return len(done)
+
+
+    def expire(self):
+        """Return the transactions with expired leases to the pending stack
+        """
+        now = time.time()
+        with self.lock:
+            expired = [key for key, (_, expires, _) in self.leases.items() if expires < now]
+            for key in expired:
+                worker, _, fields = self.leases.pop(key)
+                logger.warning('Lease expired: {} {}', worker, key)
+                self.pending[key] = fields
+        return len(expired)
+
+
+    def stats(self):
+        with self.lock:
+            workers = collections.Counter(worker for worker, _, _ in self.leases.values())
+            return {'pending': len(self.pending), 'leased': len(self.leases), 'added': self.num_added, 'acked': self.num_acked, 'workers': dict(workers)}
+
+
+    def close(self):
+        """Save the pending transactions and seen set
+        """
+        self.frontier_log.close()
+        if self.filename is not None:
+            self.seen.save(self.filename + '.bloom')
+
+
+
+class CoordinatorServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+
+def is_loopback(host):
+    """Return whether this address can only be reached from this machine
+
+    >>> is_loopback('127.0.0.1'), is_loopback('localhost'), is_loopback('0.0.0.0')
+    (True, True, False)
+    """
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host == 'localhost'
+
+
+def serve(coordinator, port=8765, host='127.0.0.1', secret=None):
+    """Serve the coordinator over XML-RPC until interrupted
+    Every call must start with the secret, which is required when listening on an address other machines can reach
+    """
+    if secret is None and not is_loopback(host):
+        raise ValueError('A secret is required to serve the coordinator on {}'.format(host))
+
+    class Handler(SimpleXMLRPCRequestHandler):
+        def log_message(self, *args):
+            pass # workers call too often to log
+
+    def authorized(fn):
+        def call(client_secret, *args):
+            if secret is not None and not (isinstance(client_secret, str) and hmac.compare_digest(client_secret, secret)):
+                raise PermissionError('Invalid coordinator secret')
+            return fn(*args)
+        return call
+
+    server = CoordinatorServer((host, port), requestHandler=Handler, allow_none=True, logRequests=False, use_builtin_types=True)
+    for name in ('add', 'lease', 'renew', 'ack', 'stats'):
+        server.register_function(authorized(getattr(coordinator, name)), name)
+    logger.info('Serving coordinator at http://{}:{}', host, server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        coordinator.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Share the frontier of a crawl between asyncrawler workers')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on, such as a private network address the workers can reach')
+    parser.add_argument('--port', type=int, default=8765, help='port to listen on')
+    parser.add_argument('--lease-time', type=float, default=60, help='seconds a worker has to complete a transaction')
+    parser.add_argument('--filename', help='sqlite database to save the pending transactions so the coordinator can be restarted')
+    parser.add_argument('--capacity', type=int, default=10 ** 7, help='expected number of transactions, to size the seen set')
+    parser.add_argument('--secret', default=os.environ.get('ASYNCRAWLER_SECRET'), help='shared secret the workers must send, required unless listening on localhost - defaults to $ASYNCRAWLER_SECRET')
+    args = parser.parse_args()
+    serve(Coordinator(args.lease_time, args.filename, args.capacity), args.port, args.host, args.secret)
+
+
+if __name__ == '__main__':
+    main()
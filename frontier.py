@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+
+import collections, heapq, itertools, os, pickle, sqlite3, threading, time, email.utils
+import asyncio
+from urllib.parse import urlsplit
+
+# status codes that show the host is overloaded, including 512 for timeouts and connection errors
+PRESSURE_STATUSES = 429, 500, 502, 503, 504, 512
+
+
+
+def get_host(url):
+    """Return the host used to schedule requests for this URL
+    """
+    return urlsplit(url).hostname or ''
+
+
+def parse_retry_after(value, max_delay=3600):
+    """Return the number of seconds to wait from a Retry-After header, which is either seconds or a HTTP date
+
+    >>> parse_retry_after('120')
+    120.0
+    >>> parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT')
+    0
+    >>> parse_retry_after('soon')
+    """
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(0, delay), max_delay)
+
+
+
+class Throttle:
+    """Adapts the number of concurrent downloads to each host with additive increase / multiplicative decrease
+    While a host is healthy its limit grows by increase for each round trip, and when it shows pressure
+    by returning 429/5XX, timing out, or slowing down the limit is multiplied by decrease.
+
+    start:
+        the initial limit for each host
+    min_limit, max_limit:
+        the range of the limit
+    increase:
+        how much to increase the limit per round trip
+    decrease:
+        the factor to reduce the limit by under pressure
+    slow_factor:
+        a download is treated as pressure when its latency is this many times the host's baseline latency
+
+    >>> throttle = Throttle(start=2, max_limit=4)
+    >>> for _ in range(3): throttle.record('example.com', 10, 200)
+    >>> throttle.limit('example.com') # grows by about 1 per round trip of limit downloads
+    3
+    >>> for _ in range(10): throttle.record('example.com', 10, 200)
+    >>> throttle.limit('example.com')
+    4
+    >>> throttle.record('example.com', 10, 503)
+    >>> throttle.limit('example.com')
+    2
+    >>> throttle.record('example.com', 10, 503) # already reduced in this round trip
+    >>> throttle.limit('example.com'), throttle.limit('other.com')
+    (2, 2)
+    """
+    def __init__(self, start=2, min_limit=1, max_limit=32, increase=1, decrease=0.5, slow_factor=4):
+        self.start, self.min_limit, self.max_limit = start, min_limit, max_limit
+        self.increase, self.decrease, self.slow_factor = increase, decrease, slow_factor
+        self.limits = {} # host -> current limit
+        self.baselines = {} # host -> typical latency when not under pressure
+        self.last_decrease = {} # host -> time the limit was last reduced
+
+
+    def limit(self, host):
+        return int(self.limits.get(host, self.start))
+
+
+    def record(self, host, latency, status):
+        """Update the limit for this host with the result of a download
+        """
+        limit = self.limits.get(host, self.start)
+        baseline = self.baselines.get(host)
+        if status in PRESSURE_STATUSES or (baseline is not None and latency > self.slow_factor * baseline):
+            now = time.time()
+            # only reduce once per round trip, so the downloads already in flight do not collapse the limit
+            if now - self.last_decrease.get(host, 0) > (baseline or latency):
+                self.last_decrease[host] = now
+                limit = max(self.min_limit, limit * self.decrease)
+        else:
+            # increase by the amount per round trip, which is spread over the limit downloads in each round trip
+            limit = min(self.max_limit, limit + self.increase / limit)
+            # the baseline follows decreases immediately and increases slowly
+            self.baselines[host] = latency if baseline is None or latency < baseline else baseline + 0.05 * (latency - baseline)
+        self.limits[host] = limit
+
+
+
+class Spill:
+    """Temporary sqlite store for the pending downloads that do not fit in memory, which are loaded back highest priority first
+    The store is recreated for each crawl because the pending transactions are also recorded in the frontier log when durable.
+
+    filename:
+        where to store the sqlite database
+    max_memory:
+        how many transactions the frontier keeps in memory before spilling those with a lower priority
+    batch_size:
+        how many transactions to write or load at once
+    """
+    def __init__(self, filename, max_memory=100000, batch_size=1000):
+        self.filename = filename
+        self.max_memory, self.batch_size = max_memory, batch_size
+        if os.path.exists(filename):
+            os.remove(filename)
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        # nothing needs to survive a crash
+        self.conn.execute('PRAGMA journal_mode=OFF;')
+        self.conn.execute('PRAGMA synchronous=OFF;')
+        self.conn.execute("""
+        CREATE TABLE spill (
+            priority REAL,
+            seq INTEGER,
+            value BLOB
+        );
+        """)
+        self.conn.execute("CREATE INDEX spill_order ON spill (priority, seq);")
+        self.buffer = [] # rows waiting to be written
+        self.seq = itertools.count()
+        self.size = 0
+        self.best = None # highest priority stored
+
+
+    def __len__(self):
+        return self.size
+
+
+    def add(self, transaction):
+        # the revalidation headers are not pickled with the transaction
+        value = pickle.dumps((transaction, transaction.conditional), pickle.HIGHEST_PROTOCOL)
+        self.buffer.append((transaction.priority, next(self.seq), value))
+        self.size += 1
+        self.best = transaction.priority if self.best is None else max(self.best, transaction.priority)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+
+    def flush(self):
+        if self.buffer:
+            self.conn.executemany("INSERT INTO spill (priority, seq, value) VALUES(?, ?, ?);", self.buffer)
+            self.conn.commit()
+            self.buffer = []
+
+
+    def load(self, limit=-1):
+        """Remove and return up to limit transactions in order of priority, with the most recently added first for the same priority
+        By default returns all the transactions
+        """
+        self.flush()
+        rows = self.conn.execute("SELECT rowid, value FROM spill ORDER BY priority DESC, seq DESC LIMIT ?;", (limit,)).fetchall()
+        self.conn.executemany("DELETE FROM spill WHERE rowid=?;", [(rowid,) for rowid, _ in rows])
+        self.conn.commit()
+        self.size -= len(rows)
+        self.best = self.conn.execute("SELECT max(priority) FROM spill;").fetchone()[0]
+        transactions = []
+        for _, value in rows:
+            transaction, conditional = pickle.loads(value)
+            transaction.conditional = conditional
+            transactions.append(transaction)
+        return transactions
+
+
+    def close(self):
+        self.conn.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+
+class Frontier:
+    """Download scheduler that keeps a separate heap of requests for each host, ordered by priority and then most recent first
+    Hosts that are ready are dispatched round-robin so a single website can not monopolise the workers,
+    except that a host with a higher priority request is dispatched before the others
+
+    loop:
+        the event loop the crawlers are running in
+    tracker:
+        the pipeline.Tracker counting work in flight, which closes the frontier once the crawl is complete
+    delay:
+        minimum number of seconds between starting requests to the same host
+    max_per_host:
+        maximum number of requests to the same host that can be downloading at once
+    throttle:
+        optional Throttle to adapt the limit for each host instead of using max_per_host
+    on_new_host:
+        optional function called with each host when it is first added, such as to resolve its address before it is downloaded
+    spill:
+        optional Spill to store the transactions on disk once too many are pending, which keeps those with the highest priority in memory
+
+    Requests can be added from any thread with put(), while the crawlers await get() and then call task_done()
+    """
+    def __init__(self, loop, tracker, delay=0, max_per_host=2, throttle=None, on_new_host=None, spill=None):
+        self.loop = loop
+        self.tracker = tracker
+        tracker.on_complete(self.close)
+        self.closed = False
+        self.delay = delay
+        self.max_per_host = max_per_host
+        self.throttle = throttle
+        self.on_new_host = on_new_host
+        self.spill = spill
+        self.lock = threading.Lock()
+        self.hosts = {} # host -> heap of (-priority, -sequence, transaction) for the pending transactions
+        self.ring = collections.deque() # hosts with pending transactions in round-robin order
+        self.next_time = {} # host -> earliest time the next request can start
+        self.in_flight = collections.defaultdict(int) # host -> number of requests currently downloading
+        self.seq = itertools.count()
+        self.priorities = [] # heap of the negated priorities in memory, where those popped are removed lazily
+        self.popped = collections.Counter() # priority -> number popped that are still in self.priorities
+        self.size = 0 # pending transactions, including those spilled
+        self.memory_size = 0
+        self.waiters = []
+
+
+    def put(self, transaction):
+        """Add transaction to the stack for its host - can be called from any thread
+        """
+        self.tracker.add()
+        with self.lock:
+            self.push(transaction)
+        self.wakeup()
+
+
+    def put_many(self, transactions):
+        """Add transactions while holding the lock once
+        """
+        if transactions:
+            self.tracker.add(len(transactions))
+            with self.lock:
+                for transaction in transactions:
+                    self.push(transaction)
+            self.wakeup()
+
+
+    def push(self, transaction):
+        """Add transaction to the heap for its host, or to the spill if memory is full and it does not have a higher priority than those in memory
+        Must be called with the lock held
+        """
+        self.size += 1
+        if self.spill is not None and self.memory_size >= self.spill.max_memory and transaction.priority <= self.best_priority():
+            self.spill.add(transaction)
+        else:
+            self.push_memory(transaction)
+
+
+    def push_memory(self, transaction):
+        host = get_host(transaction.url)
+        try:
+            heap = self.hosts[host]
+        except KeyError:
+            heap = self.hosts[host] = []
+            self.ring.append(host)
+            if self.on_new_host is not None:
+                self.on_new_host(host)
+        # the sequence breaks ties so the most recent is first, which spreads requests over the website like a stack
+        heapq.heappush(heap, (-transaction.priority, -next(self.seq), transaction))
+        heapq.heappush(self.priorities, -transaction.priority)
+        self.memory_size += 1
+
+
+    def best_priority(self):
+        """Return the highest priority of the transactions in memory
+        Must be called with the lock held
+        """
+        while self.priorities and self.popped[self.priorities[0]]:
+            self.popped[heapq.heappop(self.priorities)] -= 1
+        return -self.priorities[0] if self.priorities else float('-inf')
+
+
+    def refill(self):
+        """Load transactions from the spill when memory is running low or the spill has a higher priority
+        Must be called with the lock held
+        """
+        if self.spill is not None and len(self.spill) and (self.memory_size <= self.spill.max_memory // 2 or self.spill.best > self.best_priority()):
+            # reversed so the most recent is still first when they have the same priority
+            for transaction in reversed(self.spill.load(self.spill.batch_size)):
+                self.push_memory(transaction)
+
+
+    def empty(self):
+        return self.size == 0
+
+
+    def qsize(self):
+        return self.size
+
+
+    async def get(self):
+        """Wait for the next transaction from a host that is ready
+        Returns None once the frontier is closed
+        """
+        while True:
+            with self.lock:
+                if self.closed:
+                    return None
+                transaction, wait = self.pop()
+                if transaction is not None:
+                    return transaction
+                waiter = self.loop.create_future()
+                self.waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, wait)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self.discard(waiter)
+
+
+    def pop(self):
+        """Take the highest priority transaction from the next ready host in round-robin order
+        A ready host is only skipped when another has a higher priority, so when the priorities are equal the hosts take turns
+        Returns the transaction, or None and how long until a host with pending requests may become ready
+        Must be called with the lock held
+        """
+        self.refill()
+        now = time.time()
+        wait = None
+        best = self.best_priority()
+        chosen, chosen_priority = None, None
+        for _ in range(len(self.ring)):
+            host = self.ring[0]
+            self.ring.rotate(-1)
+            limit = self.max_per_host if self.throttle is None else self.throttle.limit(host)
+            if self.in_flight[host] >= limit:
+                continue # will wakeup when a download for this host completes
+            next_time = self.next_time.get(host, 0)
+            if next_time > now:
+                wait = next_time - now if wait is None else min(wait, next_time - now)
+                continue
+            priority = -self.hosts[host][0][0]
+            if chosen is None or priority > chosen_priority:
+                chosen, chosen_priority = host, priority
+                if priority >= best:
+                    break # no other host can have a higher priority
+        if chosen is None:
+            return None, wait
+        host = chosen
+        heap = self.hosts[host]
+        negative_priority, _, transaction = heapq.heappop(heap)
+        if not heap:
+            del self.hosts[host]
+            self.ring.remove(host)
+        self.popped[negative_priority] += 1
+        self.size -= 1
+        self.memory_size -= 1
+        self.in_flight[host] += 1
+        if self.delay:
+            self.next_time[host] = now + self.delay
+        return transaction, None
+
+
+    def task_done(self, transaction):
+        """Mark the download of this transaction complete so its host can be given more requests
+        """
+        host = get_host(transaction.url)
+        with self.lock:
+            self.in_flight[host] -= 1
+            if self.in_flight[host] <= 0:
+                del self.in_flight[host]
+        self.wakeup()
+        self.tracker.finish()
+
+
+    def record(self, transaction, latency):
+        """Adapt the schedule for this host with the result of a download
+        """
+        host = get_host(transaction.url)
+        retry_after = (transaction.response_headers or {}).get('Retry-After')
+        delay = None if retry_after is None else parse_retry_after(retry_after)
+        with self.lock:
+            if self.throttle is not None:
+                self.throttle.record(host, latency, transaction.status)
+            if delay:
+                # the host asked to wait before the next request
+                self.next_time[host] = max(self.next_time.get(host, 0), time.time() + delay)
+
+
+    def close(self):
+        """Stop the crawlers waiting for transactions
+        """
+        with self.lock:
+            self.closed = True
+        self.wakeup()
+
+
+    def wakeup(self):
+        """Notify the waiting crawlers that the state has changed
+        """
+        if self.waiters:
+            self.loop.call_soon_threadsafe(self._wakeup)
+
+    def _wakeup(self):
+        with self.lock:
+            waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def discard(self, waiter):
+        with self.lock:
+            try:
+                self.waiters.remove(waiter)
+            except ValueError:
+                pass
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+import bisect, collections, threading, time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from . import common
+logger = common.logger
+
+LATENCY_BUCKETS = 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(9)) # 1KB to 64MB
+DURATION_BUCKETS = 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5
+BUCKETS = {'download_seconds': LATENCY_BUCKETS, 'download_bytes': SIZE_BUCKETS, 'scrape_seconds': DURATION_BUCKETS}
+# name of the label of each metric in the Prometheus output
+LABELS = {'downloads': 'status', 'cache_lookups': 'result', 'busy_seconds': 'stage', 'scrape_seconds': 'callback', 'queue_size': 'queue', 'dns_lookups': 'result', 'connections': 'event'}
+
+
+
+class Histogram:
+    """Counts of observations in fixed buckets, which is cheap to record and can estimate quantiles
+
+    >>> h = Histogram((1, 2, 5))
+    >>> for value in (0.5, 1.5, 1.5, 4):
+    ...     h.observe(value)
+    >>> h.quantile(0.5)
+    2
+    >>> h.quantile(0.99)
+    5
+    """
+    __slots__ = 'buckets', 'counts', 'count', 'sum'
+
+    def __init__(self, buckets):
+        self.buckets = buckets # upper bound of each bucket
+        self.counts = [0] * (len(buckets) + 1) # the last bucket counts the values above the largest bound
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Return the upper bound of the bucket containing this quantile, or None if there are no observations
+        """
+        if not self.count:
+            return None
+        total = 0
+        for i, count in enumerate(self.counts):
+            total += count
+            if total >= q * self.count:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+
+
+
+class Metrics:
+    """Counters, histograms, and gauges of the crawl, which are cheap enough to record on every transaction
+    Counters and histograms are identified by a name and an optional label, such as downloads by status code.
+
+    >>> metrics = Metrics()
+    >>> metrics.inc('downloads', label=200)
+    >>> metrics.observe('download_seconds', 0.3)
+    >>> metrics.gauge('queue_size', lambda: 5, 'download')
+    >>> print(metrics.prometheus())  # doctest: +ELLIPSIS
+    # TYPE asyncrawler_downloads_total counter
+    asyncrawler_downloads_total{status="200"} 1
+    ...
+    asyncrawler_download_seconds_bucket{le="0.5"} 1
+    ...
+    asyncrawler_queue_size{queue="download"} 5
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(float) # (name, label) -> total
+        self.histograms = {} # (name, label) -> Histogram
+        self.gauges = {} # (name, label) -> function returning the current value
+        self.workers = {} # stage -> number of workers, to calculate utilisation
+        self.last_report = time.time(), {}
+        self.stopped = threading.Event()
+        self.server = None
+
+
+    def inc(self, name, value=1, label=None):
+        """Add value to this counter
+        """
+        with self.lock:
+            self.counters[name, label] += value
+
+
+    def observe(self, name, value, label=None):
+        """Record value in this histogram
+        """
+        with self.lock:
+            try:
+                histogram = self.histograms[name, label]
+            except KeyError:
+                histogram = self.histograms[name, label] = Histogram(BUCKETS.get(name, LATENCY_BUCKETS))
+            histogram.observe(value)
+
+
+    def gauge(self, name, fn, label=None):
+        """Register a function that returns the current value of this gauge, such as the size of a queue
+        """
+        self.gauges[name, label] = fn
+
+
+    def __getstate__(self):
+        # only the recorded values, such as to send the metrics of a shard of a clustered crawl to the launcher
+        with self.lock:
+            return {'counters': dict(self.counters), 'histograms': dict(self.histograms), 'workers': dict(self.workers)}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.counters.update(state['counters'])
+        self.histograms.update(state['histograms'])
+        self.workers = state['workers']
+
+
+    def add(self, other):
+        """Add the counters, histograms, and workers recorded by another Metrics
+        """
+        other = other.__getstate__()
+        with self.lock:
+            for key, value in other['counters'].items():
+                self.counters[key] += value
+            for key, histogram in other['histograms'].items():
+                try:
+                    total = self.histograms[key]
+                except KeyError:
+                    total = self.histograms[key] = Histogram(histogram.buckets)
+                total.counts = [a + b for a, b in zip(total.counts, histogram.counts)]
+                total.count += histogram.count
+                total.sum += histogram.sum
+        for stage, workers in other['workers'].items():
+            self.workers[stage] = self.workers.get(stage, 0) + workers
+
+
+    def merge(self, name):
+        """Return a histogram of all the labels of this metric
+        """
+        histogram = Histogram(BUCKETS.get(name, LATENCY_BUCKETS))
+        with self.lock:
+            for (other_name, _), other in self.histograms.items():
+                if other_name == name:
+                    histogram.counts = [a + b for a, b in zip(histogram.counts, other.counts)]
+                    histogram.count += other.count
+                    histogram.sum += other.sum
+        return histogram
+
+
+    def summary(self):
+        """Return a single line describing the crawl since the last summary
+        """
+        now = time.time()
+        with self.lock:
+            counters = dict(self.counters)
+        last_time, last_counters = self.last_report
+        self.last_report = now, counters
+        elapsed = max(now - last_time, 1e-6)
+        def delta(name, label):
+            return counters.get((name, label), 0) - last_counters.get((name, label), 0)
+        def percent(part, total):
+            # nothing to measure yet, such as when every download was loaded from the cache
+            return '{:.0%}'.format(part / total) if total else 'n/a'
+
+        statuses = sorted((label, value) for (name, label), value in counters.items() if name == 'downloads')
+        downloads = sum(delta('downloads', label) for label, _ in statuses)
+        latency = self.merge('download_seconds')
+        size = self.merge('download_bytes')
+        lookups = {result: counters.get(('cache_lookups', result), 0) for result in ('hit', 'miss', 'stale')}
+        dns = {result: counters.get(('dns_lookups', result), 0) for result in ('hit', 'miss', 'shared')}
+        connections = {event: counters.get(('connections', event), 0) for event in ('acquired', 'opened')}
+        parts = [
+            '{:.0f} downloads ({:.1f}/s)'.format(sum(value for _, value in statuses), downloads / elapsed),
+            'p50 {} p99 {}'.format(latency.quantile(0.5), latency.quantile(0.99)),
+            '{:.1f}MB'.format(size.sum / 1024 ** 2),
+            'status ' + ' '.join('{}:{:.0f}'.format(label, value) for label, value in statuses),
+            'cache {} hit'.format(percent(lookups['hit'], sum(lookups.values()))),
+            'dns {} hit'.format(percent(dns['hit'], sum(dns.values()))),
+            # the share of requests sent on a kept alive connection
+            'connections {:.0f} opened {} reused'.format(connections['opened'], percent(connections['acquired'] - connections['opened'], connections['acquired'])),
+            'queues ' + ' '.join('{}:{}'.format(label, fn()) for (name, label), fn in self.gauges.items() if name == 'queue_size'),
+            'busy ' + ' '.join('{} {:.0%}'.format(stage, delta('busy_seconds', stage) / elapsed / workers) for stage, workers in self.workers.items()),
+        ]
+        return ', '.join(parts)
+
+
+    def prometheus(self):
+        """Return the metrics in the Prometheus text format
+        """
+        lines = []
+        def labels(name, label, extra=''):
+            pairs = [] if label is None else ['{}="{}"'.format(LABELS.get(name, 'label'), label)]
+            if extra:
+                pairs.append(extra)
+            return '{{{}}}'.format(','.join(pairs)) if pairs else ''
+
+        with self.lock:
+            counters = sorted(self.counters.items(), key=lambda item: (item[0][0], str(item[0][1])))
+            histograms = sorted(((key, histogram.buckets, list(histogram.counts), histogram.count, histogram.sum) for key, histogram in self.histograms.items()), key=lambda item: (item[0][0], str(item[0][1])))
+        typed = set()
+        for (name, label), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE asyncrawler_{}_total counter'.format(name))
+            lines.append('asyncrawler_{}_total{} {:g}'.format(name, labels(name, label), value))
+        for (name, label), buckets, counts, count, total_sum in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE asyncrawler_{} histogram'.format(name))
+            total = 0
+            for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                total += bucket_count
+                lines.append('asyncrawler_{}_bucket{} {}'.format(name, labels(name, label, 'le="{}"'.format(bound)), total))
+            lines.append('asyncrawler_{}_sum{} {:g}'.format(name, labels(name, label), total_sum))
+            lines.append('asyncrawler_{}_count{} {}'.format(name, labels(name, label), count))
+        for (name, label), fn in sorted(self.gauges.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE asyncrawler_{} gauge'.format(name))
+            lines.append('asyncrawler_{}{} {}'.format(name, labels(name, label), fn()))
+        return '\n'.join(lines)
+
+
+    def report(self, interval):
+        """Log a summary every interval seconds in a background thread
+        """
+        def run():
+            while not self.stopped.wait(interval):
+                logger.info('Metrics: {}', self.summary())
+        threading.Thread(target=run, daemon=True).start()
+
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serve the metrics in the Prometheus text format from a background thread
+        """
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus().encode('utf-8') + b'\n'
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass # scrapes are too frequent to log
+
+        self.server = MetricsServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logger.info('Serving metrics at http://{}:{}/metrics', host, self.server.server_port)
+
+
+    def close(self):
+        """Stop the background threads and log a final summary
+        """
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        logger.info('Metrics: {}', self.summary())
+
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+
+class FakeMetrics:
+    """Class with Metrics interface that does not record anything
+    """
+    def inc(self, name, value=1, label=None):
+        pass
+
+    def observe(self, name, value, label=None):
+        pass
+
+    def gauge(self, name, fn, label=None):
+        pass
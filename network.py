@@ -1,48 +1,404 @@
 # -*- coding: utf-8 -*-
 
-import traceback, collections, os, random
+import traceback, codecs, collections, functools, inspect, ipaddress, os, random, re, json, socket, tempfile, weakref, pickle, time
+from urllib.parse import urlencode
+import asyncio
+import aiohttp
+from aiohttp.abc import AbstractResolver
+from aiohttp.resolver import AsyncResolver, ThreadedResolver
+try:
+    import aiodns
+except ImportError:
+    aiodns = None
+try:
+    import cchardet as chardet
+except ImportError:
+    try:
+        import chardet
+    except ImportError:
+        chardet = None
 from user_agent import generate_user_agent
-import yarl
-from . import common, scrape
+from . import common, frontier, metrics, scrape
 logger = common.logger
 
+# headers that do not change the response so are excluded from the transaction fingerprint
+FINGERPRINT_IGNORE = 'user-agent', 'referer'
+# status codes that indicate the proxy failed or was blocked, rather than a problem with the URL
+PROXY_ERRORS = 403, 407, 429, 512
+# response headers to keep with the transaction
+RESPONSE_HEADERS = 'Retry-After', 'ETag', 'Last-Modified', 'Cache-Control'
+# the charset declared in a HTML <meta> tag, which is searched for in the start of the body
+META_CHARSET_RE = re.compile(br'<meta[^>]+charset=["\']?([\w-]+)', re.IGNORECASE)
+
 
 
-async def fetch(session, transaction, proxy=None, user_agent='asyncrawler', timeout=60, encoding=None):
+async def fetch(session, transaction, proxy=None, user_agent='asyncrawler', timeout=60, encoding=None, limits=None):
     """Asynchronously download the URL
+    The response body is streamed in chunks so that the size limits can be enforced
     """
+    limits = limits or BodyLimits()
     request_fn = session.get if transaction.data is None else session.post
-    headers = transaction.headers or {}
-    headers['User-Agent'] = headers.get('User-Agent', user_agent)
+    headers = default_headers(user_agent)
+    if transaction.headers or transaction.conditional:
+        # copy so the shared default headers and the transaction are not modified
+        headers = dict(headers)
+        headers.update(transaction.headers or {})
+        if transaction.conditional:
+            # revalidating a stale cached response so the body is only sent if it has changed
+            headers.update(transaction.conditional)
     try:
-        url = str(yarl.URL(transaction.url))
-        async with request_fn(url, data=transaction.data, headers=headers, proxy=proxy, timeout=timeout) as response:
+        # the session parses the URL so it is passed as a string
+        async with request_fn(transaction.url, data=transaction.data, headers=headers, proxy=proxy, timeout=timeout) as response:
             transaction.status = response.status
-            content_type = response.headers.get('content-type')
-            response_fn = response.json if 'json' in content_type else (response.text if 'text' in content_type else response.read)
-            transaction.body = await response_fn(encoding=encoding, errors='ignore')
+            transaction.response_headers = {name: response.headers[name] for name in RESPONSE_HEADERS if name in response.headers} or None
+            transaction.content_type = response.headers.get('content-type') or ''
+            transaction.encoding = encoding or common.regex_get(transaction.content_type, r'charset=([\w-]+)') or None
+            content_length = response.headers.get('content-length')
+            if content_length and content_length.isdigit() and limits.too_large(int(content_length)) and not limits.truncate:
+                raise BodyTooLarge('Content-Length {}'.format(content_length))
+            # the body is decoded when accessed
+            transaction.raw, transaction.body_file = await read_body(response, limits)
+            if transaction.body_file is not None:
+                # remove the spooled body once the transaction is no longer used
+                weakref.finalize(transaction, remove_file, transaction.body_file)
             #print('Final URL: {}'.format(response.url_obj))
+    except BodyTooLarge as e:
+        logger.warning('Body too large: {}: {}', e, transaction.url)
+        transaction.raw = None
+        transaction.status = 413
     except Exception as e:
-        logger.error('Fetch error: {}: {}'.format(type(e), transaction.url))
-        logger.error(traceback.print_exc())
+        logger.error('Fetch error: {}: {}\n{}', type(e), transaction.url, traceback.format_exc())
         transaction.status = transaction.status or 512
 
 
+@functools.lru_cache(maxsize=1024)
+def default_headers(user_agent):
+    """Return the headers sent with every request for this user agent, which are shared between requests so must not be modified
+    """
+    return {'User-Agent': user_agent}
+
+
+async def read_body(response, limits):
+    """Read the response body in chunks
+    Returns the body bytes, or None and the path of the temporary file when the body was spooled to disk
+    """
+    chunks, size, spool = [], 0, None
+    try:
+        while True:
+            chunk = await response.content.read(limits.chunk_size)
+            if not chunk:
+                break
+            truncated = limits.too_large(size + len(chunk))
+            if truncated:
+                if not limits.truncate:
+                    raise BodyTooLarge('read {} bytes'.format(size + len(chunk)))
+                chunk = chunk[:limits.max_size - size]
+            size += len(chunk)
+            if spool is None and limits.should_spool(size, len(chunk)):
+                spool = tempfile.NamedTemporaryFile(dir=limits.spool_dir, prefix='asyncrawler-', delete=False)
+                spool.write(b''.join(chunks))
+                limits.release(sum(len(chunk) for chunk in chunks))
+                chunks = []
+            if spool is None:
+                limits.reserve(len(chunk))
+                chunks.append(chunk)
+            else:
+                spool.write(chunk)
+            if truncated:
+                logger.warning('Body truncated to {} bytes: {}', size, response.url)
+                break
+    except BaseException:
+        if spool is not None:
+            spool.close()
+            remove_file(spool.name)
+        raise
+    finally:
+        limits.release(sum(len(chunk) for chunk in chunks))
+    if spool is None:
+        return b''.join(chunks), None
+    spool.close()
+    return None, spool.name
+
+
+def decode_body(body, content_type, encoding=None):
+    """Decode the raw body based on its content type
+    """
+    if body is None:
+        return None
+    elif 'json' in content_type:
+        return json.loads(decode_text(body, encoding))
+    elif 'text' in content_type:
+        return decode_text(body, encoding)
+    else:
+        return body
+
+
+def decode_text(body, encoding=None):
+    """Decode the body with this encoding from the Content-Type, else the charset of its <meta> tag, else UTF-8 if valid, else the encoding detected by chardet
+    Bytes that are not valid in the encoding are replaced rather than silently dropped
+
+    >>> decode_text('<meta charset="iso-8859-1"><p>caf\xe9</p>'.encode('latin-1'))
+    '<meta charset="iso-8859-1"><p>caf\xe9</p>'
+    >>> decode_text('caf\xe9'.encode('utf-8'))
+    'caf\xe9'
+    >>> decode_text(b'caf\\xe9', 'utf-8')
+    'caf\ufffd'
+    """
+    if encoding is None:
+        match = META_CHARSET_RE.search(body[:1024])
+        if match and is_encoding(match.group(1).decode('ascii')):
+            encoding = match.group(1).decode('ascii')
+    if encoding is None:
+        try:
+            return body.decode('utf-8')
+        except UnicodeDecodeError:
+            encoding = (chardet.detect(body) if chardet is not None else {}).get('encoding') or 'utf-8'
+    if not is_encoding(encoding):
+        # an unknown charset in the Content-Type
+        return decode_text(body)
+    return body.decode(encoding, errors='replace')
+
+
+def is_encoding(encoding):
+    """Return whether Python can decode this encoding
+    """
+    try:
+        codecs.lookup(encoding)
+        return True
+    except LookupError:
+        return False
+
+
+def remove_file(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+
+class BodyLimits:
+    """Limits on the size of downloaded response bodies, which are shared by all the crawlers
+
+    max_size:
+        the maximum number of bytes of a response body
+    truncate:
+        when a body is larger than max_size keep the first max_size bytes instead of failing the download
+    spool_size:
+        bodies larger than this number of bytes are saved to a temporary file instead of kept in memory
+    max_memory:
+        the maximum total bytes of bodies being downloaded into memory at once - when exceeded new chunks are spooled to temporary files
+    spool_dir:
+        the directory for temporary files, by default the system temporary directory
+    chunk_size:
+        how many bytes to read from the response at a time
+    """
+    def __init__(self, max_size=None, truncate=False, spool_size=None, max_memory=None, spool_dir=None, chunk_size=64 * 1024):
+        self.max_size, self.truncate = max_size, truncate
+        self.spool_size, self.max_memory, self.spool_dir = spool_size, max_memory, spool_dir
+        self.chunk_size = chunk_size
+        self.memory = 0 # bytes currently buffered in memory by all downloads
+
+    def too_large(self, size):
+        return self.max_size is not None and size > self.max_size
+
+    def should_spool(self, size, chunk_size):
+        return (self.spool_size is not None and size > self.spool_size) or \
+               (self.max_memory is not None and self.memory + chunk_size > self.max_memory)
+
+    def reserve(self, size):
+        self.memory += size
+
+    def release(self, size):
+        self.memory -= size
+
+
+
+class DNSCache(AbstractResolver):
+    """Resolver that caches the addresses of each host for ttl seconds, so a crawl across many hosts does not wait on DNS for every connection
+    Lookups use aiodns when installed, else the system resolver in a thread, and concurrent lookups of the same host share a single query.
+
+    loop:
+        the event loop the crawlers are running in
+    ttl:
+        how many seconds to cache the addresses of a host
+    max_hosts:
+        the maximum number of hosts to cache, after which the least recently used are removed
+    family:
+        the address family to resolve, which the connector must also use
+    stats:
+        optional metrics.Metrics to record the lookups
+    """
+    def __init__(self, loop, ttl=300, max_hosts=100000, family=socket.AF_INET, stats=None):
+        self.loop = loop
+        self.resolver = (ThreadedResolver if aiodns is None else AsyncResolver)(loop=loop)
+        self.ttl, self.max_hosts, self.family = ttl, max_hosts, family
+        self.stats = stats or metrics.FakeMetrics()
+        self.hosts = collections.OrderedDict() # (host, family) -> (expiry time, addresses)
+        self.lookups = {} # (host, family) -> future of a lookup in progress
+
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        key = host, family
+        cached = self.hosts.get(key)
+        if cached is not None and cached[0] > time.time():
+            self.hosts.move_to_end(key)
+            self.stats.inc('dns_lookups', label='hit')
+            addresses = cached[1]
+        else:
+            addresses = await self.lookup(key)
+        # the addresses are cached for any port
+        return [dict(address, port=port) for address in addresses]
+
+
+    async def lookup(self, key):
+        """Resolve this (host, family) and cache the addresses
+        """
+        future = self.lookups.get(key)
+        if future is not None:
+            self.stats.inc('dns_lookups', label='shared')
+            return await asyncio.shield(future)
+        self.stats.inc('dns_lookups', label='miss')
+        future = self.lookups[key] = self.loop.create_future()
+        start = time.time()
+        try:
+            addresses = await self.resolver.resolve(key[0], 0, key[1])
+        except BaseException as e:
+            # also when this lookup is cancelled, such as by a request timeout, so the requests sharing it do not wait forever
+            future.set_exception(e if isinstance(e, Exception) else OSError('DNS lookup cancelled: {}'.format(key[0])))
+            future.exception() # the error is raised to the caller so does not need to be retrieved from the future
+            raise
+        finally:
+            del self.lookups[key]
+            self.stats.observe('dns_seconds', time.time() - start)
+        future.set_result(addresses)
+        self.hosts[key] = time.time() + self.ttl, addresses
+        self.hosts.move_to_end(key)
+        while len(self.hosts) > self.max_hosts:
+            self.hosts.popitem(last=False)
+        return addresses
+
+
+    def prefetch(self, host):
+        """Resolve this host in the background if not already cached, such as when it is added to the frontier
+        Can be called from any thread
+        """
+        self.loop.call_soon_threadsafe(self._prefetch, host)
+
+    def _prefetch(self, host):
+        key = host, self.family
+        cached = self.hosts.get(key)
+        if not host or key in self.lookups or (cached is not None and cached[0] > time.time()):
+            return
+        try:
+            ipaddress.ip_address(host)
+            return # addresses are not resolved
+        except ValueError:
+            pass
+        task = self.loop.create_task(self.lookup(key))
+        # a failed lookup is retried and reported when the host is downloaded
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+
+    async def close(self):
+        await self.resolver.close()
+
+
+
+class Connector(aiohttp.TCPConnector):
+    """TCPConnector that records how many requests acquire a connection and how many connections are opened, to measure keep-alive reuse
+    """
+    def __init__(self, *args, stats=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = stats or metrics.FakeMetrics()
+
+    async def connect(self, *args, **kwargs):
+        self.stats.inc('connections', label='acquired')
+        return await super().connect(*args, **kwargs)
+
+    async def _create_connection(self, *args, **kwargs):
+        self.stats.inc('connections', label='opened')
+        start = time.time()
+        try:
+            return await super()._create_connection(*args, **kwargs)
+        finally:
+            self.stats.observe('connect_seconds', time.time() - start)
+
+
+# the parameters supported by the installed aiohttp
+CONNECTOR_PARAMETERS = frozenset(inspect.signature(aiohttp.TCPConnector).parameters)
+
+def connector(loop, limit=100, limit_per_host=None, keepalive_timeout=30, resolver=None, stats=None):
+    """Return a Connector configured for crawling many hosts
+
+    limit:
+        the maximum number of open connections
+    limit_per_host:
+        the maximum number of open connections to each host, by default unlimited
+    keepalive_timeout:
+        how many seconds to keep an idle connection open for the next request to its host
+    resolver:
+        the DNSCache to resolve hosts, which replaces the connector's own DNS cache that never expires
+    """
+    kwargs = {'loop': loop, 'keepalive_timeout': keepalive_timeout}
+    if resolver is not None:
+        kwargs.update(resolver=resolver, use_dns_cache=False, family=resolver.family)
+    if 'limit_per_host' in CONNECTOR_PARAMETERS:
+        kwargs.update(limit=limit, limit_per_host=limit_per_host or 0)
+    else:
+        # older aiohttp only limits the connections to each host and the total is limited by the number of crawlers
+        kwargs.update(limit=limit_per_host or limit)
+    return Connector(stats=stats, **kwargs)
+
+
 
 class Transaction:
     """Wrapper around a HTTP request and response
+    The core fields are stored in slots to keep millions of queued transactions compact, with any other attributes in the small extras dict.
+    The body is stored as the raw bytes downloaded and decoded on each access based on the content type.
+    Transactions with a higher priority are downloaded first, and the depth is the number of links from the start of the crawl.
     """
-    def __init__(self, url, headers=None, data=None, status=0, body=None, callback=None, **kwargs):
+    __slots__ = 'url', 'headers', 'data', 'status', 'num_errors', '_raw', '_body', 'content_type', 'encoding', 'response_headers', 'body_file', 'conditional', 'priority', 'depth', '_callback', '_fingerprint', 'extras', '__weakref__'
+
+    def __init__(self, url, headers=None, data=None, status=0, body=None, callback=None, priority=0, depth=0, **kwargs):
         self.url = url
         self.headers = headers
         self.data = data
         self.status = status
         self.num_errors = 0
+        self.content_type = ''
+        self.encoding = None
+        self.response_headers = None # the response headers listed in RESPONSE_HEADERS
+        self.body_file = None # path of the body when it was spooled to disk because too large to keep in memory
+        self.conditional = None # headers to revalidate a stale cached response, which are not saved
+        self.priority = priority
+        self.depth = depth
+        self._fingerprint = None
+        self.extras = None
         self.body = body
         self.callback = callback
         for key, value in kwargs.items():
             setattr(self, key, value)
 
+    def __getattr__(self, name):
+        # only called when not a slot so check the user attributes
+        if name != 'extras' and self.extras and name in self.extras:
+            return self.extras[name]
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in FIELDS:
+            object.__setattr__(self, name, value)
+        else:
+            if self.extras is None:
+                self.extras = {}
+            self.extras[name] = value
+
     @property
     def callback(self):
         return self._callback
@@ -53,12 +409,134 @@ class Transaction:
             value = value.__name__
         self._callback = value
 
+    @property
+    def raw(self):
+        """The body as downloaded, or None when not downloaded or spooled to body_file
+        """
+        return self._raw
+
+    @raw.setter
+    def raw(self, value):
+        self._raw = value
+        self._body = None # decoded again when next accessed
+
+    @property
+    def body(self):
+        """The body decoded as JSON, text, or bytes depending on the content type
+        It is decoded when first accessed and then kept, so changes to a decoded JSON body are not lost
+        """
+        if self._body is None:
+            raw = self.raw
+            if raw is None and self.body_file is not None:
+                # spooled bodies are only loaded when needed so they are not held in memory while queued
+                with open(self.body_file, 'rb') as fp:
+                    raw = fp.read()
+            self._body = decode_body(raw, self.content_type, self.encoding)
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        if value is None or isinstance(value, bytes):
+            self.raw = value
+        elif isinstance(value, str):
+            self.raw = value.encode('utf-8')
+            self.encoding = 'utf-8'
+            if 'text' not in self.content_type and 'json' not in self.content_type:
+                self.content_type = 'text/plain'
+        else:
+            self.raw = json.dumps(value).encode('utf-8')
+            self.encoding = 'utf-8'
+            self.content_type = 'application/json'
+
+    def __getstate__(self):
+        """Pickle as a tuple of the fields, which includes a spooled body because the temporary file is removed
+        The fingerprint is recalculated in case the hash function has changed
+        """
+        raw = self.raw
+        if raw is None and self.body_file is not None:
+            with open(self.body_file, 'rb') as fp:
+                raw = fp.read()
+        return self.url, self.headers, self.data, self.status, self.num_errors, raw, self.content_type, self.encoding, self.response_headers, self._callback, self.extras, self.priority, self.depth
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # pickled before the transaction had slots
+            self.__init__(state.pop('url'))
+            for key, value in state.items():
+                if key in ('body', '_body'):
+                    self.body = value
+                elif key == '_callback':
+                    self.callback = value
+                elif key != '_fingerprint':
+                    setattr(self, key, value)
+        else:
+            if len(state) == 11:
+                # pickled before the transaction had a priority and depth
+                state += 0, 0
+            self.url, self.headers, self.data, self.status, self.num_errors, self.raw, self.content_type, self.encoding, self.response_headers, self._callback, self.extras, self.priority, self.depth = state
+            self.body_file = self.conditional = self._fingerprint = None
+
+    def dumps(self):
+        """Serialize to compact bytes, which unlike pickling the object does not include the class
+        """
+        return pickle.dumps(self.__getstate__(), pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def loads(cls, data):
+        """Load a transaction serialized with dumps()
+        """
+        transaction = cls.__new__(cls)
+        transaction.__setstate__(pickle.loads(data))
+        return transaction
+
+    def to_fields(self):
+        """Return the fields as a dict of plain data, which unlike dumps() can be safely loaded when received from another machine
+        """
+        return dict(zip(STATE_FIELDS, self.__getstate__()))
+
+    @classmethod
+    def from_fields(cls, fields):
+        """Load a transaction from the fields returned by to_fields()
+        Raises ValueError if they are not valid
+        """
+        if not isinstance(fields, dict) or not isinstance(fields.get('url'), str):
+            raise ValueError('Invalid transaction fields')
+        for name in 'headers', 'response_headers', 'extras':
+            if not isinstance(fields.get(name), (dict, type(None))):
+                raise ValueError('Invalid transaction field: {}'.format(name))
+        transaction = cls.__new__(cls)
+        transaction.__setstate__(tuple(fields.get(name, 0 if name in ('status', 'num_errors', 'priority', 'depth') else None) for name in STATE_FIELDS))
+        transaction.content_type = transaction.content_type or ''
+        return transaction
+
     def __hash__(self):
-        return common.hash('{} {} {}'.format(self.url, self.headers, self.data))
+        return self.fingerprint()
+
+    def fingerprint(self):
+        """Return a stable 64 bit hash of the request, which is calculated once and then cached
+        The URL is canonicalized, the headers sorted with those in FINGERPRINT_IGNORE skipped, and the data hashed
+        """
+        if self._fingerprint is None:
+            headers = sorted((name.lower(), str(value)) for name, value in (self.headers or {}).items() if name.lower() not in FINGERPRINT_IGNORE)
+            data = self.data
+            if isinstance(data, dict):
+                data = urlencode(sorted(data.items()))
+            elif data is not None and not isinstance(data, (str, bytes)):
+                data = str(data)
+            data_hash = 0 if data is None else common.hash(data)
+            self._fingerprint = common.hash('{} {} {}'.format(common.canonical_url(self.url), headers, data_hash))
+        return self._fingerprint
 
     def __str__(self):
         return '{}: {}'.format(self.url, self.status)
 
+    def size(self):
+        """Return the number of bytes of the downloaded body
+        """
+        if self.raw is None and self.body_file is not None:
+            return os.path.getsize(self.body_file)
+        return len(self.raw or b'')
+
     def made(self):
         """After request is made the status will not be 0
         """
@@ -73,24 +551,149 @@ class Transaction:
     def is_error(self):
         return self.status >= 400
 
+    def not_modified(self):
+        """Returns True if a conditional request found the cached response is still valid
+        """
+        return self.status == 304
+
+    def validators(self):
+        """Return the headers to make a conditional request for this response, or None if it has no ETag or Last-Modified
+        """
+        response_headers = self.response_headers or {}
+        headers = {}
+        if 'ETag' in response_headers:
+            headers['If-None-Match'] = response_headers['ETag']
+        if 'Last-Modified' in response_headers:
+            headers['If-Modified-Since'] = response_headers['Last-Modified']
+        return headers or None
+
+    def max_age(self):
+        """Return how many seconds this response can be cached for from the Cache-Control header, or None if not given
+
+        >>> Transaction('http://example.com', response_headers={'Cache-Control': 'public, max-age=3600'}).max_age()
+        3600
+        >>> Transaction('http://example.com', response_headers={'Cache-Control': 'no-cache'}).max_age()
+        0
+        """
+        cache_control = (self.response_headers or {}).get('Cache-Control', '').lower()
+        if 'no-cache' in cache_control or 'no-store' in cache_control:
+            return 0
+        max_age = common.regex_get(cache_control, r'max-age=(\d+)')
+        return int(max_age) if max_age else None
+
+    def revalidated(self, cached):
+        """Reuse the response of the cached transaction after the server replied that it was not modified
+        """
+        response_headers = dict(cached.response_headers or {})
+        # the server may send updated validators and cache lifetime
+        response_headers.update(self.response_headers or {})
+        self.status, self.raw, self.content_type, self.encoding = cached.status, cached.raw, cached.content_type, cached.encoding
+        self.response_headers = response_headers or None
+        self.body_file = self.conditional = None
+
     def merge(self, other):
         """Merge attributes of this Transaction
         """
-        for key, value in other.__dict__.items():
+        for key in ('url', 'headers', 'data', 'status', 'num_errors', 'raw', 'content_type', 'encoding', 'response_headers', 'body_file', 'callback'):
+            value = getattr(other, key)
             if value:
                 setattr(self, key, value)
+        # the request decides where it is in the crawl, even when zero
+        self.priority, self.depth = other.priority, other.depth
+        if other.extras:
+            for key, value in other.extras.items():
+                if value:
+                    setattr(self, key, value)
 
     def tree(self):
         return scrape.Tree(self.body)
 
+    def stream(self, stream):
+        """Yield the matches of this scrape.Stream while parsing the body, which is read in chunks when it was spooled to disk
+        """
+        if self.raw is None and self.body_file is not None:
+            with open(self.body_file, 'rb') as fp:
+                yield from stream.parse(fp, self.encoding)
+        else:
+            yield from stream.parse(self.raw or b'', self.encoding)
+
+FIELDS = frozenset(Transaction.__slots__) | {'raw', 'body', 'callback'} # attributes that are not stored in extras
+# the names of the values returned by Transaction.__getstate__()
+STATE_FIELDS = 'url', 'headers', 'data', 'status', 'num_errors', 'raw', 'content_type', 'encoding', 'response_headers', '_callback', 'extras', 'priority', 'depth'
+
+
+
+class ProxyStats:
+    """Health of a proxy, or of a proxy for a domain
+    Latency and error rate are exponentially weighted moving averages so recent downloads count the most
+    """
+    __slots__ = 'requests', 'latency', 'error_rate', 'errors', 'cooldowns', 'cooldown_until'
+    ALPHA = 0.2 # weight of the latest download in the moving averages
+
+    def __init__(self):
+        self.requests = 0
+        self.latency = None
+        self.error_rate = 0.0
+        self.errors = 0 # consecutive errors
+        self.cooldowns = 0 # consecutive cooldowns, for exponential backoff
+        self.cooldown_until = 0
+
+    def record(self, latency, error):
+        self.requests += 1
+        self.error_rate += self.ALPHA * ((1.0 if error else 0.0) - self.error_rate)
+        if error:
+            self.errors += 1
+        else:
+            self.errors = self.cooldowns = 0
+            if latency is not None:
+                self.latency = latency if self.latency is None else self.latency + self.ALPHA * (latency - self.latency)
+
+    def score(self):
+        """Higher is better - faster proxies with fewer errors
+        """
+        return max(0.01, 1 - self.error_rate) / max(0.01, self.latency or 1.0)
+
+    def start_cooldown(self, now, cooldown, max_cooldown):
+        self.cooldowns += 1
+        self.errors = 0
+        self.cooldown_until = now + min(max_cooldown, cooldown * 2 ** (self.cooldowns - 1))
+        return self.cooldown_until - now
+
 
 
 class ProxyManager:
-    def __init__(self, proxy=None, proxies=None, proxy_file=None, max_errors=20):
+    """Pool of proxies that are chosen by their health
+    The latency and error rate is tracked for each proxy and each (proxy, domain) pair,
+    and proxies are chosen randomly weighted by their score.
+    A proxy with too many consecutive errors is put in cooldown rather than discarded,
+    which doubles in length each time it fails again.
+
+    >>> manager = ProxyManager(proxies=['fast:8080', 'slow:8080'])
+    >>> manager.success('http://fast:8080', latency=0.1)
+    >>> manager.success('http://slow:8080', latency=2.0)
+    >>> manager.failure('http://slow:8080')
+    >>> fast, slow = manager.stats['http://fast:8080'], manager.stats['http://slow:8080']
+    >>> round(slow.error_rate, 2), fast.score() > slow.score()
+    (0.2, True)
+    >>> slow.start_cooldown(time.time(), 60, 3600) > 59
+    True
+    >>> manager.get('http://example.com') # the slow proxy is not used while cooling down
+    'http://fast:8080'
+    >>> slow.start_cooldown(time.time(), 60, 3600) > 119 # failed again after the cooldown so waits twice as long
+    True
+    >>> manager.success('http://slow:8080', latency=2.0) # recovered so the next cooldown is short again
+    >>> slow.cooldowns, slow.errors
+    (0, 0)
+    """
+    def __init__(self, proxy=None, proxies=None, proxy_file=None, max_errors=20, cooldown=60, max_cooldown=3600):
         """
-        max_errors: the maximum number of consecutive download errors before a proxy is discarded
+        max_errors: the maximum number of consecutive download errors before a proxy is put in cooldown
+        cooldown: seconds of the first cooldown for a proxy
+        max_cooldown: the maximum seconds of a cooldown
         """
         self.proxies = []
+        self.stats = {} # proxy -> ProxyStats
+        self.domain_stats = {} # (proxy, domain) -> ProxyStats
         self.add(proxy)
         for proxy in proxies or []:
             self.add(proxy)
@@ -99,9 +702,9 @@ class ProxyManager:
                 for proxy in open(proxy_file).read().splitlines():
                     self.add(proxy)
             else:
-                logger.warning('Proxy file "{}" does not exist'.format(proxy_file))
-        self.errors = collections.defaultdict(int)
+                logger.warning('Proxy file "{}" does not exist', proxy_file)
         self.max_errors = max_errors
+        self.cooldown, self.max_cooldown = cooldown, max_cooldown
         self.agents = {}
 
 
@@ -109,26 +712,64 @@ class ProxyManager:
         if proxy:
             if not proxy.startswith('http'):
                 proxy = 'http://' + proxy
-            self.proxies.append(proxy)
+            if proxy not in self.stats:
+                self.proxies.append(proxy)
+                self.stats[proxy] = ProxyStats()
 
     
     def get(self, url):
         """Get proxy for this URL
         """
-        # XXX add support to track errors by domain
-        # XXX add delay here for domain
         if self.proxies:
-            return random.choice(self.proxies)
+            now = time.time()
+            domain = frontier.get_host(url)
+            candidates, weights = [], []
+            for proxy in self.proxies:
+                stats = self.stats[proxy]
+                domain_stats = self.domain_stats.get((proxy, domain))
+                if stats.cooldown_until > now or (domain_stats and domain_stats.cooldown_until > now):
+                    continue
+                candidates.append(proxy)
+                # the domain only adjusts for errors because latency depends mostly on the proxy
+                weights.append(stats.score() * (max(0.01, 1 - domain_stats.error_rate) if domain_stats else 1))
+            if candidates:
+                return random.choices(candidates, weights)[0]
+            # all proxies are cooling down so use the one available soonest
+            return min(self.proxies, key=lambda proxy: self.stats[proxy].cooldown_until)
 
-    def success(self, proxy):
-        if proxy:
-            self.errors[proxy] = 0
+    def success(self, proxy, url=None, latency=None):
+        self.record(proxy, url, latency, False)
 
-    def failure(self, proxy):
-        if proxy:
-            self.errors[proxy] += 1
-            if self.errors[proxy] > this.max_errors:
-                self.proxies.remove(proxy)
+    def failure(self, proxy, url=None, latency=None):
+        self.record(proxy, url, latency, True)
+
+    def record(self, proxy, url, latency, error):
+        if proxy in self.stats:
+            now = time.time()
+            all_stats = [(proxy, self.stats[proxy])]
+            if url is not None:
+                key = proxy, frontier.get_host(url)
+                try:
+                    domain_stats = self.domain_stats[key]
+                except KeyError:
+                    domain_stats = self.domain_stats[key] = ProxyStats()
+                all_stats.append(('{} for {}'.format(*key), domain_stats))
+            for name, stats in all_stats:
+                stats.record(latency, error)
+                if stats.errors >= self.max_errors:
+                    duration = stats.start_cooldown(now, self.cooldown, self.max_cooldown)
+                    logger.warning('Proxy cooldown: {} for {} seconds', name, duration)
+
+    def summary(self):
+        """Return the statistics of each proxy
+        """
+        now = time.time()
+        return {proxy: {
+            'requests': stats.requests,
+            'latency': None if stats.latency is None else round(stats.latency, 3),
+            'error_rate': stats.error_rate,
+            'cooldown': max(0, stats.cooldown_until - now),
+        } for proxy, stats in self.stats.items()}
             
     def agent(self, proxy):
         """Get the user agent used for this proxy
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import queue, threading
+
+
+
+class Tracker:
+    """Counts the work in flight across all stages of the crawl
+    Every item added to a stage is counted until that stage marks it done,
+    so when the count returns to 0 nothing can produce more work and the crawl is complete.
+
+    >>> tracker = Tracker()
+    >>> tracker.add()
+    >>> tracker.is_complete()
+    False
+    >>> tracker.finish()
+    >>> tracker.is_complete()
+    True
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.complete = threading.Event()
+        self.listeners = []
+
+    def add(self, n=1):
+        with self.lock:
+            self.pending += n
+
+    def finish(self, n=1):
+        with self.lock:
+            self.pending -= n
+            done = self.pending == 0
+        if done:
+            self.stop()
+
+    def on_complete(self, fn):
+        """Register a function to call once the crawl is complete or stopped
+        """
+        self.listeners.append(fn)
+
+    def is_complete(self):
+        return self.complete.is_set()
+
+    def stop(self):
+        """End the crawl and wakeup every stage waiting for work
+        """
+        with self.lock:
+            if self.complete.is_set():
+                return
+            self.complete.set()
+        for fn in self.listeners:
+            fn()
+
+
+
+class LifoQueue(queue.LifoQueue):
+    """Thread safe stack that reports its work to a Tracker
+    It is unbounded so put() never blocks and can be called directly from the event loop.
+    When the tracker completes the queue is closed and get() returns None.
+    """
+    def __init__(self, tracker):
+        super().__init__()
+        self.tracker = tracker
+        tracker.on_complete(self.close)
+
+    def put(self, item):
+        self.tracker.add()
+        super().put(item)
+
+    def put_many(self, items):
+        """Add all items while holding the lock once
+        """
+        if items:
+            self.tracker.add(len(items))
+            with self.not_empty:
+                for item in items:
+                    self._put(item)
+                self.unfinished_tasks += len(items)
+                self.not_empty.notify(len(items))
+
+    def get_batch(self, max_size):
+        """Block until an item is available and then return up to max_size items
+        Returns None once the queue is closed
+        """
+        item = self.get()
+        if item is None:
+            return None
+        items = [item]
+        while len(items) < max_size:
+            try:
+                item = self.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # closed so leave the sentinel for the next call
+                super().put(None)
+                super().task_done()
+                break
+            items.append(item)
+        return items
+
+    def task_done(self):
+        super().task_done()
+        self.tracker.finish()
+
+    def close(self):
+        # the sentinel is not tracked and is skipped when the queue is drained
+        super().put(None)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing, pickle, signal, threading, time, traceback
+from concurrent import futures
+from . import common
+logger = common.logger
+
+user_crawl = None # the crawler instance in each worker process
+
+
+
+class RowRecorder:
+    """Stand in for the crawler's writer in worker processes
+    The rows are recorded and returned so they can be written by the parent process
+    """
+    def __init__(self):
+        self.rows = []
+
+    def writerow(self, record):
+        self.rows.append(record)
+
+
+
+def init_worker(crawl):
+    """Setup worker process with the user's crawler
+    """
+    global user_crawl
+    # the parent process handles shutting down the crawl
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    user_crawl = crawl
+    user_crawl.writer = RowRecorder()
+
+
+def scrape_worker(data):
+    """Call the scrape callback for this pickled transaction in a worker process
+    Returns the child transactions, the rows written, how many seconds the callback took, and the traceback if it failed,
+    so the links yielded and rows written before an error are still crawled and saved
+    """
+    transaction = pickle.loads(data)
+    user_crawl.writer.rows = []
+    start = time.time()
+    child_transactions = []
+    error = None
+    try:
+        for child_transaction in getattr(user_crawl, transaction.callback)(transaction) or []:
+            child_transactions.append(child_transaction)
+    except Exception:
+        error = traceback.format_exc()
+    return child_transactions, user_crawl.writer.rows, time.time() - start, error
+
+
+
+class ScrapePool:
+    """Pool of processes to run the scrape callbacks, so parsing is not limited to a single core by the GIL
+
+    user_crawl:
+        the crawler, which is copied into each worker process
+    num_processes:
+        how many worker processes to use - by default the number of cores
+    max_pending:
+        maximum number of transactions sent to the pool that are waiting for results, so the transaction bodies do not pile up in memory
+    """
+    def __init__(self, user_crawl, num_processes=None, max_pending=None):
+        self.user_crawl = user_crawl
+        self.num_processes = num_processes or multiprocessing.cpu_count()
+        self.slots = threading.BoundedSemaphore(max_pending or 2 * self.num_processes)
+        self.executor = self.start()
+
+
+    def start(self):
+        """Start the worker processes and return the executor
+        """
+        # fork so the crawler does not need to be picklable
+        context = multiprocessing.get_context('fork')
+        executor = futures.ProcessPoolExecutor(self.num_processes, mp_context=context, initializer=init_worker, initargs=(self.user_crawl,))
+        # start the workers now before the crawl threads are running, because forking a threaded process is not safe
+        executor.submit(int).result()
+        return executor
+
+
+    def submit(self, transaction, callback):
+        """Scrape this transaction in a worker process and then call callback with the future of the results
+        Blocks while max_pending transactions are already waiting
+        Raises an exception if the transaction can not be sent, in which case callback is not called,
+        such as BrokenProcessPool when a worker process has died, because the workers can not be restarted once the crawl threads are running
+        """
+        # the body is sent as part of a single pickle with the highest protocol rather than compressed,
+        # because compression would cost the parent process more CPU than it saves
+        data = pickle.dumps(transaction, pickle.HIGHEST_PROTOCOL)
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(scrape_worker, data)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        future.add_done_callback(callback)
+        return future
+
+
+    def close(self):
+        self.executor.shutdown()
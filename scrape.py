@@ -1,11 +1,33 @@
 __doc__ = """
 """
 
-import re
+import functools, re
+from urllib.parse import urljoin, urldefrag, urlsplit
 import lxml.html
+from lxml import etree
 from . import common
 
 
+@functools.lru_cache(maxsize=1024)
+def compile_xpath(path):
+    """Return the compiled XPath for this expression, so lxml only parses each expression once per process
+    Compiled XPath objects can be shared between threads
+    """
+    return etree.XPath(path)
+
+
+def get_text(node):
+    """Return the text of this node and its descendants, separated by spaces to avoid text merging when remove tags
+    """
+    if isinstance(node, str):
+        return node
+    parts = list(node.itertext())
+    if node.tail:
+        parts.append(node.tail)
+    return common.normalize(' '.join(part for part in parts if part))
+
+
+
 class Tree:
     """Convenience wrapper around lxml
     """
@@ -25,25 +47,33 @@ class Tree:
                 print(type(e))
                 raise error
 
+    @classmethod
+    def wrap(cls, node):
+        """Return a Tree for a result of xpath(), which is an element or a string, without parsing it again
+        """
+        tree = cls.__new__(cls)
+        tree.doc = node
+        return tree
+
     def xpath(self, path):
-        return [] if self.doc is None else self.doc.xpath(path)
+        return [] if self.doc is None else compile_xpath(path)(self.doc)
 
     def get(self, path):
         es = self.xpath(path)
         if es:
-            return Tree(es[0])
+            return Tree.wrap(es[0])
         return Tree(lxml.html.HtmlElement())
 
     def search(self, path):
-        return [Tree(e) for e in self.xpath(path)]
+        return [Tree.wrap(e) for e in self.xpath(path)]
+
+    def text(self, path):
+        """Return the text of each result of this path, without creating a Tree for each
+        """
+        return [get_text(e) for e in self.xpath(path)]
 
     def __str__(self):
-        node = self.doc
-        if isinstance(node, str):
-            return node
-        else:
-            # use a space separator to avoid text merging when remove tags
-            return common.normalize(' '.join(e for e in [node.text] + [str(Tree(child)) for child in node if isinstance(child, lxml.html.HtmlElement)] + [node.tail] if e))
+        return '' if self.doc is None else get_text(self.doc)
 
     def html(self):
         node = self.doc
@@ -54,6 +84,102 @@ class Tree:
 
 
 
+class Stream:
+    """Extracts elements while the HTML is parsed, rather than building the whole document like Tree
+    Register the elements wanted with add(), then iterate parse() to receive each match as soon as it is complete.
+    Parsing stops once every rule has reached its limit, and the elements already processed are cleared so memory stays bounded,
+    so copy what is needed from a match before continuing the iteration.
+
+    chunk_size:
+        how many bytes or characters to feed the parser at a time
+
+    >>> stream = Stream()
+    >>> stream.add('title', 'title', limit=1)
+    >>> stream.add('link', 'a', 'self::a[@href]')
+    >>> [(name, element.text) for name, element in stream.parse('<title>Blog</title><a href="/1">1</a><a>2</a><a href="/3">3</a>')]
+    [('title', 'Blog'), ('link', '1'), ('link', '3')]
+    >>> stream = Stream()
+    >>> stream.add('title', 'title', limit=1)
+    >>> [name for name, _ in stream.parse('<title>Blog</title>' + '<p>text</p>' * 10000)] # stops after the title
+    ['title']
+    """
+    def __init__(self, chunk_size=16384):
+        self.chunk_size = chunk_size
+        self.rules = [] # (name, tag, compiled XPath or None, limit)
+
+
+    def add(self, name, tag, xpath=None, limit=None):
+        """Match the elements with this tag, which are returned by parse() with this name
+
+        xpath:
+            optional condition evaluated relative to the element, such as 'self::a[@href]' or 'contains(@class, "price")'
+        limit:
+            the maximum number of elements to match, after which this rule is satisfied
+        """
+        self.rules.append((name, tag, None if xpath is None else compile_xpath(xpath), limit))
+
+
+    def parse(self, source, encoding=None):
+        """Parse the HTML and yield a (name, element) for each element that matches a rule
+
+        source:
+            the HTML as a string, bytes, or a binary file to read in chunks
+        encoding:
+            the encoding of bytes, else detected from the HTML
+        """
+        tags = {}
+        for name, tag, xpath, limit in self.rules:
+            tags.setdefault(tag, []).append(name)
+        counts = {name: 0 for name, _, _, _ in self.rules}
+        unlimited = any(limit is None for _, _, _, limit in self.rules)
+        # only report events for the tags of the rules, so the other elements are parsed without calling back into Python,
+        # and for the html element, which the parser always creates, to find the root
+        parser = etree.HTMLPullParser(events=('start', 'end'), tag=list(tags) + ['html'], encoding=None if isinstance(source, str) else encoding)
+        root = None
+        open_candidates = 0 # elements being parsed that may match, whose descendants must be kept for the xpath conditions
+        for chunk in self.chunks(source):
+            parser.feed(chunk)
+            for event, element in parser.read_events():
+                if root is None and element.tag == 'html':
+                    root = element
+                if element.tag not in tags:
+                    continue
+                if event == 'start':
+                    open_candidates += 1
+                    continue
+                open_candidates -= 1
+                for name, tag, xpath, limit in self.rules:
+                    if tag == element.tag and (limit is None or counts[name] < limit) and (xpath is None or xpath(element)):
+                        counts[name] += 1
+                        yield name, element
+                if not unlimited and all(counts[name] >= limit for name, _, _, limit in self.rules):
+                    return
+            if root is not None and not open_candidates:
+                self.discard(root)
+        parser.close()
+
+
+    def chunks(self, source):
+        if hasattr(source, 'read'):
+            for chunk in iter(lambda: source.read(self.chunk_size), b''):
+                yield chunk
+        else:
+            for i in range(0, len(source), self.chunk_size):
+                yield source[i:i + self.chunk_size]
+
+
+    def discard(self, root):
+        """Free the elements that have been completely parsed, which are all but the last child at each level of the document
+        This also frees the elements that do not match any rule, so memory stays bounded when the matches are rare
+        """
+        node = root
+        while len(node):
+            last = node[-1]
+            del node[:-1]
+            node = last
+
+
+
 class Form:
     """Helper class for filling and submitting forms
     """
@@ -83,43 +209,52 @@ class Form:
 
 
 js_re = re.compile('location.href ?= ?[\'"](.*?)[\'"]')
+LINKS_XPATH = '//a/@href | //iframe/@src'
 def get_links(html, url=None, local=True, external=True):
     """Return all links from html and convert relative to absolute if source url is provided
+    Links are returned in the order found without fragments or duplicates
 
     html:
-        HTML to parse
+        HTML to parse, or a Tree that is already parsed
     url:
         optional URL for determining path of relative links
     local:
         whether to include links from same domain
     external:
         whether to include linkes from other domains
+
+    >>> get_links('<a href="/a#top">A</a><a href="mailto:x@y.com">B</a><iframe src="http://other.com"></iframe><a href="/a">A</a>', 'http://webscraping.com/blog')
+    ['http://webscraping.com/a', 'http://other.com']
+    >>> get_links('<a href="/a">A</a><a href="http://other.com">B</a>', 'http://webscraping.com', external=False)
+    ['http://webscraping.com/a']
+    >>> get_links('<a href="/a">A</a><a href="http://other.com">B</a>', 'http://webscraping.com', local=False)
+    ['http://other.com']
+    >>> get_links('<a href="/a">A</a><a href="http://other.com">B</a>', 'http://webscraping.com', local=False, external=False)
+    []
     """
-    def normalize_link(link):
-        if urlparse.urlsplit(link).scheme in ('http', 'https', ''):
-            if '#' in link:
-                link = link[:link.index('#')]
-            if url:
-                link = urlparse.urljoin(url, link)
-                if not local and common.same_domain(url, link):
-                    # local links not included
-                    link = None
-                if not external and not common.same_domain(url, link):
-                    # external links not included
-                    link = None
-        else:
-            link = None # ignore mailto, etc
-        return link
-    a_links = search(html, '//a/@href')
-    i_links = search(html, '//iframe/@src')
-    js_links = js_re.findall(html)
-    links = []
-    for link in a_links + i_links + js_links:
+    if not (local or external):
+        return []
+    if isinstance(html, Tree):
+        tree = html
+        html = '' if tree.doc is None else lxml.html.tostring(tree.doc, encoding='unicode')
+    else:
+        tree = Tree(html)
+    domain = common.get_domain(url) if url else None
+    links, seen = [], set()
+    for link in tree.xpath(LINKS_XPATH) + js_re.findall(html):
         try:
-            link = normalize_link(link)
-        except UnicodeError:
-            pass
-        else:
-            if link and link not in links:
-                links.append(link)
+            if url:
+                link = urljoin(url, link.strip())
+            link = urldefrag(link)[0]
+            if urlsplit(link).scheme not in ('http', 'https', ''):
+                continue # ignore mailto, etc
+            if domain is not None and not (local and external):
+                if (common.get_domain(link) == domain) != local:
+                    # local or external links not included
+                    continue
+        except ValueError:
+            continue # invalid URL
+        if link and link not in seen:
+            seen.add(link)
+            links.append(link)
     return links
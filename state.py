@@ -1,36 +1,156 @@
 # -*- coding: utf-8 -*-
 
+import sqlite3, threading, time
+from . import network
 
-STATE_KEY = 'queue'
 
 
-def clear_queue(cache):
-    try:
-        del cache[STATE_KEY]
-    except KeyError:
+class FrontierLog:
+    """Durable record of the transactions that are still pending, so an interrupted crawl can be resumed from any point
+    A transaction is added when discovered and removed once it has been scraped or has failed.
+    Changes are buffered and saved in a single sqlite transaction, so a crash can only lose the last flush_interval seconds.
+
+    filename:
+        where to store the sqlite database
+    batch_size:
+        save the buffered changes once this many are pending
+    flush_interval:
+        maximum number of seconds changes are buffered before being saved
+    compact_interval:
+        after this many transactions are removed the free pages are returned to the filesystem
+    transaction_class:
+        the Transaction class used to load the pending transactions
+
+    >>> log = FrontierLog('frontier_test.db')
+    >>> log.add([network.Transaction('http://example.com/1'), network.Transaction('http://example.com/2')])
+    >>> log.done(network.Transaction('http://example.com/1'))
+    >>> log.close()
+    >>> log = FrontierLog('frontier_test.db') # resumed after the crawl was interrupted
+    >>> [transaction.url for transaction in log.load()]
+    ['http://example.com/2']
+    >>> log.add([network.Transaction('http://example.com/2')]) # added again when rediscovered
+    >>> len(log)
+    1
+    >>> log.close()
+    >>> import os; os.remove('frontier_test.db')
+    """
+    def __init__(self, filename, batch_size=1000, flush_interval=1, compact_interval=100000, transaction_class=network.Transaction):
+        self.filename = filename
+        self.transaction_class = transaction_class
+        self.batch_size, self.flush_interval, self.compact_interval = batch_size, flush_interval, compact_interval
+        self.conn = sqlite3.connect(filename, isolation_level='DEFERRED', check_same_thread=False)
+        # must be set before the table is created for compaction to be incremental
+        self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL;')
+        self.conn.execute('PRAGMA journal_mode=WAL;')
+        self.conn.execute('PRAGMA synchronous=NORMAL;')
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS frontier (
+            key INTEGER NOT NULL PRIMARY KEY,
+            value BLOB
+        );
+        """)
+        self.lock = threading.Lock()
+        self.pending = {} # key -> pickled transaction to add, or None to remove
+        self.last_flush = time.time()
+        self.removed = 0
+
+
+    def __len__(self):
+        self.flush()
+        return self.conn.execute("SELECT count(*) FROM frontier;").fetchone()[0]
+
+
+    def add(self, transactions):
+        """Record these transactions as pending
+        """
+        with self.lock:
+            for transaction in transactions:
+                self.pending[transaction.fingerprint()] = transaction.dumps()
+            self.check_flush()
+
+
+    def done(self, transaction):
+        """Record this transaction is complete
+        """
+        with self.lock:
+            self.pending[transaction.fingerprint()] = None
+            self.check_flush()
+
+
+    def check_flush(self):
+        if len(self.pending) >= self.batch_size or time.time() - self.last_flush > self.flush_interval:
+            self._flush()
+
+
+    def flush(self):
+        """Save the buffered changes
+        """
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        self.last_flush = time.time()
+        if self.pending:
+            added = [(key, value) for key, value in self.pending.items() if value is not None]
+            removed = [(key,) for key, value in self.pending.items() if value is None]
+            self.pending = {}
+            self.conn.executemany("INSERT OR REPLACE INTO frontier (key, value) VALUES(?, ?);", added)
+            self.conn.executemany("DELETE FROM frontier WHERE key=?;", removed)
+            self.conn.commit()
+            self.removed += len(removed)
+            if self.removed >= self.compact_interval:
+                self.compact()
+
+
+    def compact(self):
+        """Return the pages freed by completed transactions to the filesystem
+        """
+        self.removed = 0
+        # executescript steps the pragma to completion, whereas execute only frees a single page
+        self.conn.executescript('PRAGMA incremental_vacuum;')
+        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+
+
+    def load(self):
+        """Return the pending transactions
+        """
+        self.flush()
+        return [self.transaction_class.loads(row[0]) for row in self.conn.execute("SELECT value FROM frontier;")]
+
+
+    def clear(self):
+        """Remove all pending transactions
+        """
+        with self.lock:
+            self.pending = {}
+            self.conn.execute("DELETE FROM frontier;")
+            self.conn.commit()
+            self.compact()
+
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+
+class FakeLog:
+    """Class with FrontierLog interface that does not store data
+    """
+    def __len__(self):
+        return 0
+
+    def add(self, transactions):
+        pass
+
+    def done(self, transaction):
         pass
 
+    def load(self):
+        return []
 
-def save_queue(cache, dl_queue, scrape_queue):
-    dls = []
-    scrapes = []
-    for queue, storage in [(dl_queue, dls), (scrape_queue, scrapes)]:
-        while not queue.empty():
-            e = queue.get()
-            storage.append(e)
-            queue.task_done()
-    cache[STATE_KEY] = dls, scrapes
-
-
-def load_queue(cache, dl_queue, scrape_queue):
-    try:
-        dls, scrapes = cache[STATE_KEY]
-    except KeyError:
-        size = 0
-    else:
-        for dl in dls:
-            dl_queue.put(dl)
-        for scrape in scrapes:
-            scrape_queue.put(scrape)
-        size = len(dls) + len(scrapes)
-    return size > 0
+    def clear(self):
+        pass
+
+    def close(self):
+        pass
@@ -1,14 +1,34 @@
 # -*- coding: utf-8 -*-
 
-import collections, os, datetime, time, sqlite3, zlib, pickle
+import argparse, collections, concurrent.futures, glob, os, datetime, time, sqlite3, zlib, pickle, threading, math, struct
 from . import common
+logger = common.logger
 
+MAX_VARIABLES = 500 # maximum number of keys to lookup in a single query, which must be within the sqlite limit of 999
+
+
+def to_key(value):
+    """Return a stable 64 bit integer key for this value
+    Integers are used directly and objects with a fingerprint, such as a Transaction, use that
+
+    >>> to_key(5)
+    5
+    >>> to_key('http://webscraping.com') == to_key('http://webscraping.com')
+    True
+    """
+    if isinstance(value, int):
+        return value
+    fingerprint = getattr(value, 'fingerprint', None)
+    if fingerprint is not None:
+        return fingerprint()
+    return common.hash(str(value))
 
 
 class PersistentDict:
     """
     PersistentDict has a dictionary like interface and a sqlite backend
     It uses pickle to store Python objects and strings, which are then compressed
+    Keys are stored as 64 bit integers, so other keys are converted with to_key()
     Multithreading is supported
 
     filename: 
@@ -17,8 +37,25 @@ class PersistentDict:
         between 1-9 (in my test levels 1-3 produced a 1300kb file in ~7 seconds while 4-9 a 288kb file in ~9 seconds)
     expires: 
         a timedelta object of how old data can be before expires. By default is set to None to disable.
+        When set, a value saved with a max_age expires after that many seconds instead.
     timeout: 
         how long should a thread wait for sqlite to be ready (in ms)
+    batch_size:
+        enable write-behind mode, where writes are buffered and saved together in a single transaction by a background thread once this many are pending
+    flush_interval:
+        in write-behind mode the maximum number of seconds a write is buffered before being saved
+    journal_mode:
+        the sqlite journal mode - WAL lets the cache be read while buffered writes are saved
+    synchronous:
+        the sqlite synchronous setting - NORMAL is safe in WAL mode and avoids syncing the disk on every commit
+    max_size, max_rows:
+        optional limit of the bytes or number of values stored, beyond which values are evicted
+    eviction:
+        which values to evict when over the limit - 'lru' for the least recently accessed, or 'oldest' for the least recently updated
+    maintenance_interval:
+        how often in seconds a background thread deletes the expired values and evicts over the limit, when either is enabled
+    purge_batch:
+        how many values to delete in each sqlite transaction, so maintenance does not lock out the crawl
 
     >>> cache = PersistentDict()
     >>> url = 'http://webscraping.com/blog'
@@ -47,39 +84,97 @@ class PersistentDict:
     False
     >>> os.remove(cache.filename)
     """
-    def __init__(self, filename, compress_level=6, expires=None, timeout=10000, max_operations=1000):
+    def __init__(self, filename, compress_level=6, expires=None, timeout=10000, max_operations=1000, batch_size=None, flush_interval=1, journal_mode='WAL', synchronous='NORMAL',
+            max_size=None, max_rows=None, eviction='lru', maintenance_interval=60, purge_batch=1000):
         """initialize a new PersistentDict with the specified database file.
         """
+        if eviction not in ('lru', 'oldest'):
+            raise ValueError('Unknown eviction: {}'.format(eviction))
         self.filename = filename
         self.compress_level, self.expires, self.timeout = compress_level, expires, timeout
-        self.conn = sqlite3.connect(filename, timeout=timeout, isolation_level='DEFERRED', detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES, check_same_thread=False)
-        self.conn.text_factory = lambda x: unicode(x, 'utf-8', 'replace')
+        self.journal_mode, self.synchronous = journal_mode, synchronous
+        self.max_size, self.max_rows, self.eviction, self.purge_batch = max_size, max_rows, eviction, purge_batch
+        self.conn = self.connect()
+        # must be set before the table is created so the space of deleted values can be reclaimed incrementally
+        self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL;')
+        self.conn.execute('PRAGMA journal_mode={};'.format(journal_mode))
         sql = """
         CREATE TABLE IF NOT EXISTS cache (
-            key TEXT NOT NULL PRIMARY KEY UNIQUE,
+            key INTEGER NOT NULL PRIMARY KEY,
             value BLOB,
-            updated timestamp DEFAULT (datetime('now', 'localtime'))
+            updated timestamp DEFAULT (datetime('now', 'localtime')),
+            max_age INTEGER,
+            accessed timestamp
         );
         """
         self.conn.execute(sql)
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(cache);')]
+        # caches created before values had their own lifetime or access time
+        for column, column_type in (('max_age', 'INTEGER'), ('accessed', 'timestamp')):
+            if column not in columns:
+                self.conn.execute('ALTER TABLE cache ADD COLUMN {} {};'.format(column, column_type))
+        self.conn.execute('CREATE INDEX IF NOT EXISTS cache_updated ON cache (updated);')
+        # the access times are only needed to evict the least recently used, so otherwise are not saved or indexed
+        self.track_access = bool(max_size or max_rows) and eviction == 'lru'
+        if self.track_access:
+            self.conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed);')
+            self.insert_sql = "INSERT OR REPLACE INTO cache (key, value, updated, max_age, accessed) VALUES(?1, ?2, ?3, ?4, ?3);"
+            self.touch_sql = "UPDATE cache SET updated=?1, max_age=?2, accessed=?1 WHERE key=?3;"
+        else:
+            # an index left by opening with lru eviction would still be updated on every write
+            self.conn.execute('DROP INDEX IF EXISTS cache_accessed;')
+            self.insert_sql = "INSERT OR REPLACE INTO cache (key, value, updated, max_age) VALUES(?1, ?2, ?3, ?4);"
+            self.touch_sql = "UPDATE cache SET updated=?1, max_age=?2 WHERE key=?3;"
+        self.conn.commit()
+        self.accessed = set() # keys read since the access times were last saved
+        self.access_lock = threading.Lock()
         self.operations = 0
         self.max_operations = max_operations
+        self.closed = False
+        # write-behind buffers of key -> (serialized value, updated, max_age)
+        self.buffer = {} # pending writes
+        self.flushing = {} # writes currently being saved
+        self.batch_size, self.flush_interval = batch_size, flush_interval
+        self.flush_requested = False
+        self.error = None # the error of the last write-behind save, which is raised by flush() until a save succeeds
+        self.saves = 0 # how many times the write-behind thread has tried to save
+        self.cond = threading.Condition()
+        self.writer = None
+        if batch_size:
+            self.writer = threading.Thread(target=self.write_behind, daemon=True)
+            self.writer.start()
+        self.stopped = threading.Event()
+        if maintenance_interval and (expires is not None or max_size or max_rows):
+            threading.Thread(target=self.maintenance, args=(maintenance_interval,), daemon=True).start()
 
 
     def __del__(self):
-        self.conn.commit()
+        self.close()
+
+
+    def connect(self, timeout=None):
+        """Open a connection to the database file, which waits up to timeout seconds for a lock
+        """
+        conn = sqlite3.connect(self.filename, timeout=self.timeout if timeout is None else timeout, isolation_level='DEFERRED', detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES, check_same_thread=False)
+        conn.text_factory = lambda x: x.decode('utf-8', 'replace')
+        conn.execute('PRAGMA synchronous={};'.format(self.synchronous))
+        return conn
 
 
     def __contains__(self, key):
         """check the database to see if a key exists
         """
-        row = self.conn.execute("SELECT updated FROM cache WHERE key=?;", (key,)).fetchone()
-        return row and self.is_fresh(row[0])
+        key = to_key(key)
+        if self.buffered(key) is not None:
+            return True
+        row = self.conn.execute("SELECT updated, max_age FROM cache WHERE key=?;", (key,)).fetchone()
+        return row and self.is_fresh(row[0], row[1])
 
 
     def __iter__(self):
         """iterate each key in the database
         """
+        self.flush()
         c = self.conn.cursor()
         c.execute("SELECT key FROM cache;")
         for row in c:
@@ -93,6 +188,7 @@ class PersistentDict:
     def __len__(self):
         """Return the number of entries in the cache
         """
+        self.flush()
         c = self.conn.cursor()
         c.execute("SELECT count(*) FROM cache;")
         return c.fetchone()[0]
@@ -101,9 +197,14 @@ class PersistentDict:
     def __getitem__(self, key):
         """return the value of the specified key or raise KeyError if not found
         """
-        row = self.conn.execute("SELECT value, updated FROM cache WHERE key=?;", (key,)).fetchone()
+        key = to_key(key)
+        buffered = self.buffered(key)
+        if buffered is not None:
+            return self.deserialize(buffered[0])
+        row = self.conn.execute("SELECT value, updated, max_age FROM cache WHERE key=?;", (key,)).fetchone()
         if row:
-            if self.is_fresh(row[1]):
+            self.record_access([key])
+            if self.is_fresh(row[1], row[2]):
                 value = row[0]
                 return self.deserialize(value)
             else:
@@ -112,27 +213,211 @@ class PersistentDict:
             raise KeyError("Key `%s' does not exist" % key)
 
 
+    def get_many(self, keys):
+        """Return a dict of the fresh values for the keys that exist in the cache
+        """
+        return self.lookup(keys)[0]
+
+
+    def lookup(self, keys):
+        """Return a dict of the fresh values and a dict of the stale values for the keys that exist in the cache
+        Keys are looked up with a single query for each chunk of MAX_VARIABLES
+        """
+        fresh, stale = {}, {}
+        remaining = {}
+        for key in keys:
+            buffered = self.buffered(to_key(key))
+            if buffered is None:
+                remaining[to_key(key)] = key
+            else:
+                fresh[key] = self.deserialize(buffered[0])
+        remaining = list(remaining.items())
+        for i in range(0, len(remaining), MAX_VARIABLES):
+            chunk = remaining[i:i + MAX_VARIABLES]
+            # caches created before keys were integers return text, so map back to the original keys by string
+            originals = {str(int_key): key for int_key, key in chunk}
+            sql = "SELECT key, value, updated, max_age FROM cache WHERE key IN ({});".format(','.join('?' * len(chunk)))
+            found = []
+            for int_key, value, updated, max_age in self.conn.execute(sql, [int_key for int_key, _ in chunk]):
+                results = fresh if self.is_fresh(updated, max_age) else stale
+                results[originals[str(int_key)]] = self.deserialize(value)
+                found.append(int_key)
+            self.record_access(found)
+        return fresh, stale
+
+
+    def record_access(self, keys):
+        """Remember these keys were read, which are saved in a batch by the maintenance thread rather than writing on every read
+        """
+        if self.track_access and keys:
+            with self.access_lock:
+                self.accessed.update(keys)
+
+
+    def touch(self, ages):
+        """Mark these values as updated now without rewriting them, such as when a download was not modified
+
+        ages:
+            a dict of key -> the new max_age for that value
+        """
+        updated = datetime.datetime.now()
+        saved = {}
+        for key, max_age in ages.items():
+            buffered = self.buffered(to_key(key))
+            if buffered is None:
+                saved[to_key(key)] = max_age
+            else:
+                # still waiting to be saved, so save again with the new time rather than flushing
+                with self.cond:
+                    self.buffer[to_key(key)] = buffered[0], updated, max_age
+        self.conn.executemany(self.touch_sql, [
+            (updated, max_age, key) for key, max_age in saved.items()]
+        )
+        self.commit()
+
+
     def __delitem__(self, key):
         """remove the specifed value from the database
         """
-        self.conn.execute("DELETE FROM cache WHERE key=?;", (key,))
+        self.flush()
+        self.conn.execute("DELETE FROM cache WHERE key=?;", (to_key(key),))
         self.commit()
 
 
     def __setitem__(self, key, value):
         """set the value of the specified key
         """
+        self.set(key, value)
+
+
+    def set(self, key, value, max_age=None):
+        """set the value of the specified key, which when expires is set can have its own lifetime of max_age seconds
+        """
+        key = to_key(key)
         updated = datetime.datetime.now()
-        self.conn.execute("INSERT OR REPLACE INTO cache (key, value, updated) VALUES(?, ?, ?);", (
-            key, self.serialize(value), updated)
-        )
-        self.commit()
+        # compress in the calling thread so the write-behind thread only has to save
+        value = self.serialize(value)
+        if self.writer is None:
+            self.conn.execute(self.insert_sql, (
+                key, value, updated, max_age)
+            )
+            self.commit()
+        else:
+            with self.cond:
+                # the buffer is bounded so wait when the writes are falling behind, but not while a failed batch is being retried
+                self.cond.wait_for(lambda: len(self.buffer) < 2 * self.batch_size or self.error is not None or not self.writer.is_alive())
+                self.buffer[key] = value, updated, max_age
+                if len(self.buffer) >= self.batch_size:
+                    self.cond.notify_all()
 
 
     def commit(self):
         self.operations += 1
-        if self.operations % self.max_operations == 0:
+        # in write-behind mode commit immediately so the write-behind thread is not locked out
+        if self.writer is not None or self.operations % self.max_operations == 0:
+            self.conn.commit()
+
+
+    def buffered(self, key):
+        """Return the (serialized value, updated, max_age) of a write that has not yet been saved, else None
+        """
+        if self.writer is not None:
+            with self.cond:
+                return self.buffer.get(key) or self.flushing.get(key)
+
+
+    def write_behind(self):
+        """Background thread that saves the buffered writes in batches
+        A batch that fails, such as when the database is locked or the disk is full, is retried after flush_interval seconds or when flushed
+        """
+        # use a separate connection so the cache can still be read while saving
+        conn = self.connect()
+        error = None
+        while True:
+            with self.cond:
+                # after an error the buffer is not saved as soon as it is full, else the retries would never pause
+                self.cond.wait_for(lambda: (error is None and len(self.buffer) >= self.batch_size) or self.flush_requested or self.closed, self.flush_interval)
+                self.flushing, self.buffer = self.buffer, {}
+                self.flush_requested = False
+                closed = self.closed
+                self.cond.notify_all()
+            error = None
+            if self.flushing:
+                try:
+                    conn.executemany(self.insert_sql, [
+                        (key,) + row for key, row in self.flushing.items()]
+                    )
+                    conn.commit()
+                except Exception as e:
+                    logger.error('Cache write error: {}: {}: {} values', self.filename, e, len(self.flushing))
+                    error = e
+                    try:
+                        conn.rollback()
+                    except sqlite3.Error:
+                        pass
+            with self.cond:
+                self.error = error
+                self.saves += 1
+                if error is not None and not closed:
+                    # retry the batch, keeping any newer writes of the same keys
+                    self.flushing.update(self.buffer)
+                    self.buffer = self.flushing
+                self.flushing = {}
+                self.cond.notify_all()
+            if closed:
+                break
+        conn.close()
+
+
+    def flush(self):
+        """Save all pending writes to disk
+        In write-behind mode raises the error when they could not be saved, in which case they are still retried in the background
+
+        >>> cache = PersistentDict('flush_test.db', batch_size=10, flush_interval=60, timeout=0.1)
+        >>> lock = sqlite3.connect('flush_test.db')
+        >>> _ = lock.execute('BEGIN IMMEDIATE;')
+        >>> cache[1] = 'a'
+        >>> try:
+        ...     cache.flush()
+        ... finally:
+        ...     common.logger.flush() # the error is also logged
+        Traceback (most recent call last):
+        sqlite3.OperationalError: database is locked
+        >>> cache[2] = 'b'
+        >>> lock.rollback()
+        >>> cache.flush()
+        >>> cache.close()
+        >>> sorted(PersistentDict('flush_test.db'))
+        [1, 2]
+        >>> for filename in glob.glob('flush_test.db*'): os.remove(filename)
+        """
+        if self.writer is None:
+            self.conn.commit()
+        else:
+            with self.cond:
+                # wake the writer to save the buffer immediately rather than waiting for a full batch or the next retry
+                self.flush_requested = True
+                self.cond.notify_all()
+                saves = self.saves
+                self.cond.wait_for(lambda: not (self.buffer or self.flushing) or (self.error is not None and self.saves > saves) or not self.writer.is_alive())
+                if self.error is not None and self.buffer:
+                    raise self.error
+
+
+    def close(self):
+        """Save pending writes and stop the write-behind and maintenance threads
+        """
+        if not self.closed:
+            self.stopped.set()
+            with self.cond:
+                self.closed = True
+                self.cond.notify_all()
+            if self.writer is not None:
+                self.writer.join()
             self.conn.commit()
+            if self.error is not None:
+                # the last batch could not be saved before closing
+                raise self.error
 
 
     def serialize(self, value):
@@ -147,22 +432,359 @@ class PersistentDict:
             return pickle.loads(zlib.decompress(value))
 
 
-    def is_fresh(self, t):
-        """returns whether this datetime has expired
+    def is_fresh(self, t, max_age=None):
+        """returns whether this datetime has expired, using max_age seconds instead of expires when given
         """
-        return self.expires is None or datetime.datetime.now() - t < self.expires
+        if self.expires is None:
+            return True
+        expires = self.expires if max_age is None else datetime.timedelta(seconds=max_age)
+        return datetime.datetime.now() - t < expires
 
 
     def clear(self):
         """Clear all cached data
         """
+        self.flush()
         self.conn.execute("DELETE FROM cache;")
+        self.commit()
+
+
+    def purge(self):
+        """Delete the expired values
+        Returns the number deleted
+        """
+        self.flush()
+        return self._purge(self.conn)
+
+
+    def _purge(self, conn):
+        """Delete the expired values in batches of purge_batch, using the index on updated to find them
+        Values with a shorter max_age are kept until expires so they can still be revalidated
+        """
+        if self.expires is None:
+            return 0
+        now = datetime.datetime.now()
+        total = 0
+        while not self.stopped.is_set():
+            c = conn.execute("""DELETE FROM cache WHERE key IN (
+                SELECT key FROM cache WHERE updated < ? AND (max_age IS NULL OR julianday(updated) + max_age / 86400.0 < julianday(?)) LIMIT ?
+            );""", (now - self.expires, now, self.purge_batch))
+            # commit each batch so the crawl can write in between
+            conn.commit()
+            total += c.rowcount
+            if c.rowcount < self.purge_batch:
+                break
+        return total
+
+
+    def evict(self):
+        """Delete values until within max_size and max_rows
+        Returns the number deleted
+        """
+        self.flush()
+        return self._evict(self.conn)
+
+
+    def _evict(self, conn):
+        """Delete the least recently accessed or updated values in batches of purge_batch until within the limits
+        """
+        if not (self.max_size or self.max_rows):
+            return 0
+        self._save_access(conn)
+        order = 'accessed' if self.eviction == 'lru' else 'updated'
+        total = 0
+        while not self.stopped.is_set():
+            excess = self.excess(conn)
+            if excess <= 0:
+                break
+            c = conn.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY {} LIMIT ?);".format(order), (min(excess, self.purge_batch),))
+            conn.commit()
+            total += c.rowcount
+            if not c.rowcount:
+                break
+        return total
+
+
+    def excess(self, conn):
+        """Return how many values need to be deleted to be within max_size and max_rows
+        """
+        num_rows = conn.execute("SELECT count(*) FROM cache;").fetchone()[0]
+        excess = 0 if self.max_rows is None else num_rows - self.max_rows
+        if self.max_size:
+            page_size = conn.execute('PRAGMA page_size;').fetchone()[0]
+            used_pages = conn.execute('PRAGMA page_count;').fetchone()[0] - conn.execute('PRAGMA freelist_count;').fetchone()[0]
+            used = used_pages * page_size
+            if used > self.max_size:
+                # assume the values are a similar size
+                excess = max(excess, math.ceil(num_rows * (used - self.max_size) / used))
+        return excess
+
+
+    def _save_access(self, conn):
+        """Save the access times of the keys read since last saved
+        """
+        with self.access_lock:
+            keys, self.accessed = self.accessed, set()
+        if keys:
+            accessed = datetime.datetime.now()
+            conn.executemany("UPDATE cache SET accessed=? WHERE key=?;", [(accessed, key) for key in keys])
+            conn.commit()
+
+
+    def maintain(self, conn=None, vacuum_pages=1000):
+        """Delete the expired values, evict values over the limits, and return up to vacuum_pages free pages to the filesystem
+        Returns the number of values deleted
+        """
+        conn = conn or self.conn
+        deleted = self._purge(conn) + self._evict(conn)
+        # only reclaims space in caches created with incremental vacuum, else vacuum() is needed to convert
+        # execute() only steps the pragma once, which frees a single page
+        conn.executescript('PRAGMA incremental_vacuum({});'.format(int(vacuum_pages)))
+        return deleted
+
+
+    def maintenance(self, interval):
+        """Background thread that maintains the cache every interval seconds
+        """
+        # use a separate connection so the crawl can use the cache in between batches,
+        # which gives up waiting for a lock before the next interval rather than blocking for the full timeout
+        conn = self.connect(timeout=min(self.timeout, interval))
+        while not self.stopped.wait(interval):
+            try:
+                if self.writer is None:
+                    # without write-behind the writes are committed every max_operations, so release the write lock
+                    self.conn.commit()
+                deleted = self.maintain(conn)
+                if deleted:
+                    logger.debug('Cache maintenance deleted {} values from {}', deleted, self.filename)
+            except sqlite3.Error as e:
+                logger.warning('Cache maintenance error: {}: {}', self.filename, e)
+        conn.close()
 
 
     def vacuum(self):
+        """Rebuild the database file, which also converts caches created before incremental vacuum so maintenance can reclaim space
+        """
+        self.flush()
+        self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL;')
         self.conn.execute('VACUUM')
 
 
+    def rows(self):
+        """Iterate the stored (key, serialized value, updated, max_age) rows, such as to copy them to another cache without decompressing
+        """
+        self.flush()
+        for row in self.conn.execute("SELECT key, value, updated, max_age FROM cache;"):
+            yield row
+
+
+    def insert_rows(self, rows):
+        """Save rows returned by rows()
+        """
+        self.flush()
+        self.conn.executemany(self.insert_sql, rows)
+        self.conn.commit()
+
+
+
+def shard_filenames(filename):
+    """Return the filenames of the shards of a ShardedPersistentDict that exist, in order
+    """
+    shards = {}
+    for shard_filename in glob.glob(glob.escape(filename) + '.*'):
+        index = shard_filename[len(filename) + 1:]
+        if index.isdigit():
+            shards[int(index)] = shard_filename
+    return [shards[index] for index in sorted(shards)]
+
+
+
+class ShardedPersistentDict:
+    """PersistentDict interface that spreads the keys over num_shards sqlite files by their hash
+    Each shard has its own connection and write-behind thread so threads using different shards do not wait on each other,
+    and each file stays small enough to vacuum or back up separately.
+    The shards are stored as filename.0, filename.1, ... and an existing cache can be changed to a different number of shards with reshard().
+
+    filename:
+        the prefix of the shard files
+    num_shards:
+        how many sqlite files to spread the keys over, which must match the shards that already exist
+    kwargs:
+        passed to the PersistentDict of each shard, with max_size and max_rows divided between the shards
+
+    >>> cache = ShardedPersistentDict('sharded_test.db', num_shards=4)
+    >>> for i in range(20):
+    ...     cache[i] = str(i)
+    >>> len(cache), cache[3], 25 in cache
+    (20, '3', False)
+    >>> sorted(cache.get_many([3, 7, 25]).items())
+    [(3, '3'), (7, '7')]
+    >>> [len(shard) for shard in cache.shards]
+    [5, 5, 5, 5]
+    >>> cache.close()
+    >>> for filename in glob.glob('sharded_test.db.*'): os.remove(filename)
+    """
+    def __init__(self, filename, num_shards=8, **kwargs):
+        existing = shard_filenames(filename)
+        if existing and len(existing) != num_shards:
+            raise ValueError('{} has {} shards so can not be opened with {} - use reshard() to change them'.format(filename, len(existing), num_shards))
+        self.filename = filename
+        for limit in ('max_size', 'max_rows'):
+            if kwargs.get(limit):
+                # keys are spread evenly so each shard gets an equal share of the limit
+                kwargs[limit] = max(1, kwargs[limit] // num_shards)
+        self.shards = [PersistentDict('{}.{}'.format(filename, index), **kwargs) for index in range(num_shards)]
+        self.expires = self.shards[0].expires
+        self.executor = concurrent.futures.ThreadPoolExecutor(num_shards)
+
+
+    def shard(self, key):
+        """Return the PersistentDict storing this key
+        """
+        return self.shards[to_key(key) % len(self.shards)]
+
+
+    def group(self, keys):
+        """Return a dict of shard -> keys stored in that shard
+        """
+        groups = collections.defaultdict(list)
+        for key in keys:
+            groups[self.shard(key)].append(key)
+        return groups
+
+
+    def map(self, fn, shards):
+        """Call fn with each shard in parallel and return the results
+        sqlite releases the GIL while querying so the shards can be read and written at the same time
+        """
+        return list(self.executor.map(fn, shards))
+
+
+    def __contains__(self, key):
+        return key in self.shard(key)
+
+    def __iter__(self):
+        for shard in self.shards:
+            yield from shard
+
+    def __nonzero__(self):
+        return True
+
+    def __len__(self):
+        return sum(self.map(len, self.shards))
+
+    def __getitem__(self, key):
+        return self.shard(key)[key]
+
+    def __delitem__(self, key):
+        del self.shard(key)[key]
+
+    def __setitem__(self, key, value):
+        self.shard(key).set(key, value)
+
+    def set(self, key, value, max_age=None):
+        self.shard(key).set(key, value, max_age)
+
+
+    def get_many(self, keys):
+        return self.lookup(keys)[0]
+
+
+    def lookup(self, keys):
+        """Return a dict of the fresh values and a dict of the stale values, looking up each shard in parallel
+        """
+        fresh, stale = {}, {}
+        groups = self.group(keys)
+        for shard_fresh, shard_stale in self.map(lambda shard: shard.lookup(groups[shard]), list(groups)):
+            fresh.update(shard_fresh)
+            stale.update(shard_stale)
+        return fresh, stale
+
+
+    def touch(self, ages):
+        groups = self.group(ages)
+        self.map(lambda shard: shard.touch({key: ages[key] for key in groups[shard]}), list(groups))
+
+
+    def flush(self):
+        self.map(PersistentDict.flush, self.shards)
+
+
+    def close(self):
+        self.map(PersistentDict.close, self.shards)
+        self.executor.shutdown()
+
+
+    def clear(self):
+        self.map(PersistentDict.clear, self.shards)
+
+
+    def purge(self, index=None):
+        """Delete the expired values from the shard at this index, or from every shard
+        Returns the number deleted
+        """
+        shards = self.shards if index is None else [self.shards[index]]
+        return sum(shard.purge() for shard in shards)
+
+
+    def evict(self, index=None):
+        """Delete values over the limits from the shard at this index, or from every shard
+        Returns the number deleted
+        """
+        shards = self.shards if index is None else [self.shards[index]]
+        return sum(shard.evict() for shard in shards)
+
+
+    def vacuum(self, index=None):
+        """Vacuum the shard at this index, or each shard in turn so only one is locked at a time
+        """
+        for shard in (self.shards if index is None else [self.shards[index]]):
+            shard.vacuum()
+
+
+
+def reshard(filename, num_shards, compress_level=6):
+    """Move the values in the cache at filename, which is either a PersistentDict or a ShardedPersistentDict, into num_shards shards
+    The serialized values are copied without decompressing, so the compress_level should match the original cache
+    """
+    sources = [filename] if os.path.exists(filename) else shard_filenames(filename)
+    if not sources:
+        raise ValueError('No cache found at {}'.format(filename))
+    tmp_filename = filename + '.reshard'
+    for tmp in shard_filenames(tmp_filename):
+        os.remove(tmp)
+    destination = ShardedPersistentDict(tmp_filename, num_shards, compress_level=compress_level)
+    num_rows = 0
+    for source_filename in sources:
+        source = PersistentDict(source_filename)
+        groups = collections.defaultdict(list)
+        for key, value, updated, max_age in source.rows():
+            # caches created before keys were integers return text
+            key = int(key) if str(key).lstrip('-').isdigit() else to_key(key)
+            groups[destination.shard(key)].append((key, value, updated, max_age))
+            num_rows += 1
+            if num_rows % 10000 == 0:
+                for shard, rows in groups.items():
+                    shard.insert_rows(rows)
+                groups.clear()
+        for shard, rows in groups.items():
+            shard.insert_rows(rows)
+        source.close()
+        source.conn.close()
+    destination.close()
+    for shard in destination.shards:
+        # closing the last connection moves the write-ahead log into the database file so it can be renamed
+        shard.conn.close()
+    # only replace the original files once all the values are copied
+    for source_filename in sources:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(source_filename + suffix):
+                os.remove(source_filename + suffix)
+    for index, tmp in enumerate(shard_filenames(tmp_filename)):
+        os.rename(tmp, '{}.{}'.format(filename, index))
+    return num_rows
+
+
 
 class HashDict:
     """For storing large quantities of keys where don't need the original value of the key
@@ -203,7 +825,98 @@ class HashDict:
         return self.d.get(self.to_hash(name), default)
 
     def to_hash(self, value):
-        return common.hash(str(value))
+        return to_key(value)
+
+
+class BloomDict:
+    """For tracking which keys have been seen in a fixed amount of memory, using a Bloom filter
+    Keys that were added are always found, however keys that were not added may also be found with probability error_rate
+
+    capacity:
+        the expected number of keys
+    error_rate:
+        the probability of a false positive once capacity keys have been added
+
+    >>> bd = BloomDict(1000)
+    >>> url = 'http://webscraping.com'
+    >>> bd[url] = True
+    >>> url in bd
+    True
+    >>> 'other url' in bd
+    False
+    >>> len(bd)
+    1
+    >>> BloomDict.estimate_size(10 ** 6, 0.001)
+    1797199
+    """
+    HEADER = struct.Struct('<QQQ')
+
+    def __init__(self, capacity=10 ** 6, error_rate=0.001):
+        self.num_bits = self.estimate_size(capacity, error_rate) * 8
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray(self.num_bits // 8)
+        self.count = 0
+
+    @staticmethod
+    def estimate_size(capacity, error_rate):
+        """Return the number of bytes needed to store capacity keys with this error rate
+        """
+        return math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2 / 8)
+
+    def __len__(self):
+        """Approximately how many keys are stored in the BloomDict
+        """
+        return self.count
+
+    def __contains__(self, name):
+        bits = self.bits
+        return all(bits[i >> 3] & (1 << (i & 7)) for i in self.positions(name))
+
+    def __getitem__(self, name):
+        if name in self:
+            return True
+        raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        bits = self.bits
+        added = False
+        for i in self.positions(name):
+            mask = 1 << (i & 7)
+            if not bits[i >> 3] & mask:
+                bits[i >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+
+    def get(self, name, default=None):
+        return True if name in self else default
+
+    def positions(self, value):
+        """Return the bit positions for this value using double hashing of the two halves of its 64 bit key
+        """
+        key = to_key(value) & 0xFFFFFFFFFFFFFFFF
+        h1 = key & 0xFFFFFFFF
+        h2 = (key >> 32) | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def save(self, filename):
+        """Save the bit array so the seen keys can be loaded into a later crawl
+        """
+        with open(filename, 'wb') as fp:
+            fp.write(self.HEADER.pack(self.num_bits, self.num_hashes, self.count))
+            fp.write(self.bits)
+
+    def load(self, filename):
+        """Load the bit array saved by a previous crawl
+        Returns whether the file existed
+        """
+        if not os.path.exists(filename):
+            return False
+        with open(filename, 'rb') as fp:
+            self.num_bits, self.num_hashes, self.count = self.HEADER.unpack(fp.read(self.HEADER.size))
+            self.bits = bytearray(fp.read())
+        return True
+
 
 
 class FakeDict:
@@ -232,3 +945,35 @@ class FakeDict:
 
     def get(self, key, default=None):
         return default
+
+    def set(self, key, value, max_age=None):
+        pass
+
+    def get_many(self, keys):
+        return {}
+
+    def lookup(self, keys):
+        return {}, {}
+
+    def touch(self, ages):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Change the number of shards of a cache')
+    parser.add_argument('filename', help='the cache, such as cache.db for a PersistentDict or the prefix of a ShardedPersistentDict')
+    parser.add_argument('num_shards', type=int, help='number of shards to spread the cache over')
+    parser.add_argument('--compress-level', type=int, default=6, help='the compression level the cache was created with')
+    args = parser.parse_args()
+    print('Resharded {} values'.format(reshard(args.filename, args.num_shards, args.compress_level)))
+
+
+if __name__ == '__main__':
+    main()
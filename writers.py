@@ -1,30 +1,354 @@
 # -*- coding: utf-8 -*-
 
-import csv
+import atexit, csv, gzip, json, os, threading, weakref
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # file locking is not available on Windows
+try:
+    import pyarrow, pyarrow.parquet
+except ImportError:
+    pyarrow = None
+from . import common
+logger = common.logger
 
+WRITERS = weakref.WeakSet() # the writers in use, which are held weakly so the exit and fork hooks do not keep them alive
 
-class CacheWriter:
-    def __init__(self, filename, header):
+
+
+def open_file(filename, mode):
+    """Open a text file for the rows, which is compressed with gzip when the filename ends with .gz
+    """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 't', encoding='utf-8', newline='')
+    return open(filename, mode, encoding='utf-8', newline='')
+
+
+def part_filename(filename, part):
+    """Return the filename for this part of a rotated output
+
+    >>> part_filename('results.csv', 0)
+    'results.csv'
+    >>> part_filename('results.csv', 2)
+    'results.2.csv'
+    >>> part_filename('results.jsonl.gz', 2)
+    'results.2.jsonl.gz'
+    """
+    if not part:
+        return filename
+    compressed = '.gz' if filename.endswith('.gz') else ''
+    root, ext = os.path.splitext(filename[:len(filename) - len(compressed)])
+    return '{}.{}{}{}'.format(root, part, ext, compressed)
+
+
+def part_filenames(filename):
+    """Return the filenames of the parts of this output that exist, in order
+    """
+    filenames = []
+    while os.path.exists(part_filename(filename, len(filenames))):
+        filenames.append(part_filename(filename, len(filenames)))
+    return filenames
+
+
+def close_writers():
+    """Write the buffered rows of every writer when the interpreter exits
+    """
+    for writer in list(WRITERS):
+        writer.close()
+
+
+def after_fork_writers():
+    for writer in list(WRITERS):
+        writer.after_fork()
+
+
+atexit.register(close_writers)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=after_fork_writers)
+
+
+
+class Writer:
+    """Base class for saving the scraped results, which buffers the rows in memory and writes them in batches from a background thread
+    writerow() can be called from any thread and only blocks when max_buffer rows are waiting to be written.
+    The buffered rows are written by flush() or close(), which is also called when the interpreter exits.
+
+    filename:
+        where to save the rows
+    header:
+        the names of the fields
+    batch_size:
+        write the buffered rows once this many are waiting
+    flush_interval:
+        maximum number of seconds a row is buffered before being written
+    max_buffer:
+        maximum number of rows waiting to be written
+    max_rows, max_bytes:
+        optionally start a new part of the output once this many rows or bytes have been written, such as results.1.csv
+    lock:
+        lock the file while writing each batch so several processes can append to the same file, which is then never truncated
+    """
+    mergeable = True # whether the output files of a cluster can be concatenated
+
+    def __init__(self, filename, header=None, batch_size=1000, flush_interval=1, max_buffer=10000, max_rows=None, max_bytes=None, lock=False):
         self.filename = filename
         self.header = header
-        self.writer = None
         self.mode = 'w' # default mode is write, which can be changed to append when continuing crawl
+        self.batch_size, self.flush_interval, self.max_buffer = batch_size, flush_interval, max_buffer
+        self.max_rows, self.max_bytes = max_rows, max_bytes
+        self.lock = lock and fcntl is not None
+        self.fp = None
+        self.parent_fp = None # the file inherited when forked
+        self.part = 0 # index of the part being written
+        self.part_rows = 0 # rows written to this part
+        self.new_file = False # whether the header needs to be written
+        self.buffer = []
+        self.writing = False # whether the background thread is writing a batch
+        self.stopping = False
+        self.flush_requested = False
+        self.cond = threading.Condition()
+        self.thread = None
+        WRITERS.add(self)
+
 
     def writerow(self, record):
-        """Write result to CSV
-        """
-        if self.writer is None:
-            # need to create the writer for the first write
-            self.writer = csv.writer(open(self.filename, self.mode))
-            if 'a' not in self.mode:
-                # not append mode so need to write the header
-                self.writer.writerow(self.encode(self.header))
+        """Add a row, which is a list of values in the order of the header or a dict of field -> value
+        """
+        # convert in the calling thread so the background thread only has to write
+        row = self.convert(record)
+        with self.cond:
+            # wait when the writes are falling behind
+            self.cond.wait_for(lambda: len(self.buffer) < self.max_buffer or self.thread is None or not self.thread.is_alive())
+            self.buffer.append(row)
+            if self.thread is None or not self.thread.is_alive():
+                self.stopping = False
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            if len(self.buffer) >= self.batch_size:
+                self.cond.notify_all()
+
+
+    def run(self):
+        """Background thread that writes the buffered rows in batches
+        """
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: len(self.buffer) >= self.batch_size or self.flush_requested or self.stopping, self.flush_interval)
+                rows, self.buffer = self.buffer, []
+                self.writing = bool(rows)
+                self.flush_requested = False
+                stopping = self.stopping
+                self.cond.notify_all()
+            if rows:
+                try:
+                    self.write_batch(rows)
+                except Exception as e:
+                    logger.error('Writer error: {}: {}: {}', self.filename, type(e), e)
+            with self.cond:
+                self.writing = False
+                self.cond.notify_all()
+            if stopping:
+                break
+
+
+    def write_batch(self, rows):
+        """Write these rows, starting a new part whenever the current part is full
+        """
+        while rows:
+            if self.fp is None:
+                self.open_part()
+            if self.max_rows and self.part_rows >= self.max_rows:
+                # a continued part that is already full
+                self.next_part()
+                continue
+            count = len(rows) if self.max_rows is None else max(1, self.max_rows - self.part_rows)
+            batch, rows = rows[:count], rows[count:]
+            if self.lock:
+                fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX)
+            try:
+                if self.new_file and (not self.lock or os.path.getsize(self.current_filename()) == 0):
+                    self.write_header()
+                self.new_file = False
+                self.write_rows(batch)
+                if hasattr(self.fp, 'flush'):
+                    self.fp.flush()
+            finally:
+                if self.lock:
+                    fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
+            self.part_rows += len(batch)
+            if (self.max_rows and self.part_rows >= self.max_rows) or (self.max_bytes and os.path.getsize(self.current_filename()) >= self.max_bytes):
+                self.next_part()
+
+
+    def next_part(self):
+        self.close_file()
+        self.part += 1
+        # later parts are always new files
+        self.mode = 'w'
+
+
+    def current_filename(self):
+        return part_filename(self.filename, self.part)
+
+
+    def open_part(self):
+        """Open the current part of the output
+        """
+        if 'a' in self.mode:
+            # continue the last part of the previous crawl
+            self.part = max(self.part, len(part_filenames(self.filename)) - 1)
+        elif self.part == 0:
+            # remove the parts of a previous crawl
+            for filename in part_filenames(self.filename)[1:]:
+                os.remove(filename)
+        filename = self.current_filename()
+        # when shared between processes the file is always appended to and the header only written if it is empty
+        mode = 'a' if self.lock else self.mode
+        existing = 'a' in mode and os.path.exists(filename) and os.path.getsize(filename) > 0
+        self.new_file = self.lock or not existing
+        # count the rows already in a continued part so it is still rotated at max_rows
+        self.part_rows = self.count_rows(filename) if existing and self.max_rows else 0
+        self.fp = self.open(filename, mode)
+
+
+    def flush(self):
+        """Wait until the buffered rows are written
+        """
+        with self.cond:
+            if self.thread is not None:
+                self.flush_requested = True
+                self.cond.notify_all()
+                self.cond.wait_for(lambda: not (self.buffer or self.writing) or not self.thread.is_alive())
+
+
+    def close(self):
+        """Write the buffered rows and close the file, after which any more rows are appended
+        """
+        with self.cond:
+            thread = self.thread
+            self.stopping = True
+            self.cond.notify_all()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        with self.cond:
+            self.thread = None
+        if self.fp is not None:
+            self.close_file()
+            self.mode = 'a'
+
+
+    def close_file(self):
+        self.fp.close()
+        self.fp = None
+
+
+    def after_fork(self):
+        # threads and locks are not copied into forked processes so need a new writer
+        self.cond = threading.Condition()
+        self.thread = None
+        self.writing = False
+        # the buffered rows are written by the parent, and its file is kept referenced but unused
+        # so it is not flushed or closed from this process
+        self.buffer = []
+        self.parent_fp, self.fp = self.fp, None
+
+
+    def convert(self, record):
+        """Return the row to buffer for this record
+        """
         if isinstance(record, dict):
-            row = [record.get(field) for field in self.header]
-        else:
-            row = record
-        self.writer.writerow(self.encode(row))
+            return [record.get(field) for field in self.header]
+        return record
+
+
+    def count_rows(self, filename):
+        """Return the number of rows already saved in this file
+        """
+        with open_file(filename, 'r') as fp:
+            return sum(1 for _ in fp)
+
+    def open(self, filename, mode):
+        raise NotImplementedError()
+
+    def write_header(self):
+        pass
+
+    def write_rows(self, rows):
+        raise NotImplementedError()
+
+
+
+class CacheWriter(Writer):
+    """Write the rows to CSV, which is compressed with gzip when the filename ends with .gz
+    """
+    def open(self, filename, mode):
+        fp = open_file(filename, mode)
+        self.writer = csv.writer(fp)
+        return fp
+
+    def write_header(self):
+        if self.header:
+            self.writer.writerow(self.encode(self.header))
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+
+    def count_rows(self, filename):
+        with open_file(filename, 'r') as fp:
+            rows = sum(1 for _ in csv.reader(fp))
+        return max(0, rows - 1) if self.header else rows
+
+    def convert(self, record):
+        return self.encode(super().convert(record))
 
     def encode(self, row):
         return [None if e is None else str(e).strip() for e in row]
-        #return [e.encode() for e in row]
+
+
+
+class JsonLinesWriter(Writer):
+    """Write each row as a line of JSON, which keeps the types of the values and is compressed with gzip when the filename ends with .gz
+    List rows are written as objects with the header fields when there is a header
+    """
+    def open(self, filename, mode):
+        return open_file(filename, mode)
+
+    def convert(self, record):
+        if not isinstance(record, dict) and self.header:
+            record = dict(zip(self.header, record))
+        # values that JSON does not support, such as datetimes, are saved as strings
+        return json.dumps(record, ensure_ascii=False, default=str)
+
+    def write_rows(self, rows):
+        self.fp.write(''.join(row + '\n' for row in rows))
+
+
+
+class ParquetWriter(Writer):
+    """Write the rows to the Parquet columnar format with each batch as a row group, which requires pyarrow
+    The values are saved as strings like CSV. Parquet files can not be appended to, so a continued crawl starts a new part.
+    """
+    mergeable = False
+
+    def __init__(self, filename, header, batch_size=10000, **kwargs):
+        if pyarrow is None:
+            raise ImportError('ParquetWriter requires pyarrow')
+        kwargs.pop('lock', None) # files can not be shared between processes
+        super().__init__(filename, header, batch_size=batch_size, **kwargs)
+        self.schema = pyarrow.schema([(str(field), pyarrow.string()) for field in header])
+
+    def open_part(self):
+        if 'a' in self.mode:
+            self.part = len(part_filenames(self.filename))
+            self.mode = 'w'
+        super().open_part()
+
+    def open(self, filename, mode):
+        return pyarrow.parquet.ParquetWriter(filename, self.schema)
+
+    def write_rows(self, rows):
+        columns = {field.name: [row[i] for row in rows] for i, field in enumerate(self.schema)}
+        self.fp.write_table(pyarrow.Table.from_pydict(columns, schema=self.schema))
+
+    def convert(self, record):
+        return [None if e is None else str(e) for e in super().convert(record)]